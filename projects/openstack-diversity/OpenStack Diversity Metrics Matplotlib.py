@@ -26,17 +26,34 @@
 
 
 import matplotlib
+matplotlib.use('Agg')
 import numpy as np
-import matplotlib.pyplot as plt
 
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime
 
+import os
 import pandas
+import tempfile
+import time
+
+from rollup import GenderRollup
+from util import ESConnection, QueryCache, close_connection, composite_buckets
+from elasticsearch_dsl import MultiSearch, Search, Q
+from elasticsearch_dsl.response import Response
 
-from util import ESConnection
-from elasticsearch_dsl import Search, Q
+# Cache of query results, set up by main
+query_cache = None
+# Pre-aggregated metrics, loaded by main when given
+query_rollup = None
 
-es_conn = ESConnection()
+# Gender series drawn in the charts, in legend order
+GENDERS = ["male", "female", "NotKnown"]
 
 
 
@@ -71,7 +88,7 @@ es_conn = ESConnection()
 
 # In[407]:
 
-def evol_chart(title, x_data, y_data, y_legend, file_name):
+def evol_chart(title, x_data, y_data, y_legend, file_name, output_dir="/tmp"):
     ''' Save evolutionary charts in line format
 
     :param title: chart title
@@ -79,17 +96,22 @@ def evol_chart(title, x_data, y_data, y_legend, file_name):
     :param y_data: list of lists containing the values to display in Y
     :param y_legend: list of values with the legend of Y values
     :param file_name: file name
+    :param output_dir: directory where the chart is saved
 
     :type title: string
     :type x_data: list of datetime strings that follow the format %Y-%m-%dT
     :type y_data: list of lists of values
     :type y_legend: list of strings. As many as lists in y_data
     :type file_name: string
+    :type output_dir: string
     '''
 
-    fig = plt.figure()
+    # Figures are not registered in pyplot, so no global state is shared
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
 
-    plt.title(title)
+    ax.set_title(title)
 
     dates = []
     for unixdate in x_data:
@@ -97,114 +119,297 @@ def evol_chart(title, x_data, y_data, y_legend, file_name):
         dates.append(datetime.strptime(date, "%Y-%m-%d"))
 
     for y in y_data:
-        plt.plot(dates, y)
+        ax.plot(dates, y)
 
     fig.autofmt_xdate()
 
     # loc = 2 => legend is displayed at the top left side of the chart
-    plt.legend(y_legend, loc=2)
-    #plt.show()
-
-    fig.savefig("/tmp/" + file_name)
+    ax.legend(y_legend, loc=2)
 
-    plt.close()
+    fig.savefig(os.path.join(output_dir, file_name))
 
 
-def pie_chart(title, labels, fractions, file_name):
+def pie_chart(title, labels, fractions, file_name, output_dir="/tmp"):
     ''' Build and save pie chart
 
     :param title: title of the chart
     :param labels: list of labels
     :param fractions: list of percentages to be represented
     :param file_name: name of the file used to save
+    :param output_dir: directory where the chart is saved
 
     :type title: string
     :type labels: list of strings
     :type fractions: list of floats
     :type file_name: string
+    :type output_dir: string
     '''
 
-    fig = plt.figure(1, figsize=(8,8))
-    ax = plt.axes([0.1, 0.1, 0.8, 0.8])
+    fig = Figure(figsize=(8,8))
+    FigureCanvasAgg(fig)
+    ax = fig.add_axes([0.1, 0.1, 0.8, 0.8])
 
-    plt.pie(fractions, labels=labels, autopct='%1.1f%%', startangle=90)
+    ax.pie(fractions, labels=labels, autopct='%1.1f%%', startangle=90)
 
-    plt.title(title)
-    fig.savefig("/tmp/" + file_name)
+    ax.set_title(title)
+    fig.savefig(os.path.join(output_dir, file_name))
 
-    plt.close()
 
+class ChartRenderer:
+    ''' Render the charts of a project in a pool of processes
 
-def project_list(index):
-    s = Search(using=es_conn, index=index)
-    s.aggs.bucket('projects', 'terms', field='projects', size=700)
-    result = s.execute()
+    Charts are queued with `evol_chart` and `pie_chart`, which take the
+    same arguments as the functions of the same name, and are rendered
+    while the next queries run. `wait` blocks until every queued chart
+    is saved and raises the first error found.
 
-    value = result.to_dict()["aggregations"]["projects"]["buckets"]
-    df = pandas.DataFrame()
-    df2 = pandas.DataFrame()
-    for i in value:
-        df2["project"] = [i["key"]]
-        df = pandas.concat([df, df2])
+    :param pool: ProcessPoolExecutor shared by the renderers of all
+        the projects
+    :param output_dir: directory where charts are saved
+    '''
 
-    return list(df["project"])
+    def __init__(self, pool, output_dir="/tmp"):
+        self.output_dir = output_dir
+        self.pool = pool
+        self.futures = []
+        self.rendered = 0
 
+    def evol_chart(self, title, x_data, y_data, y_legend, file_name, output_dir=None):
+        # Plain lists are cheaper to send to the workers than pandas series
+        self.futures.append(self.pool.submit(evol_chart, title, list(x_data),
+                                             [list(y) for y in y_data], y_legend, file_name,
+                                             output_dir or self.output_dir))
 
-def query_metric_over_time(index, metric_name, metric_field, filters = []):
+    def pie_chart(self, title, labels, fractions, file_name, output_dir=None):
+        self.futures.append(self.pool.submit(pie_chart, title, list(labels), list(fractions),
+                                             file_name, output_dir or self.output_dir))
+
+    def wait(self):
+        futures, self.futures = self.futures, []
+        error = None
+
+        for future in futures:
+            try:
+                future.result()
+                self.rendered += 1
+            except Exception as e:
+                error = error or e
+
+        if error:
+            raise error
+
+
+def project_list(index):
+    s = Search(using=ESConnection(), index=index)
+    sources = [{'project': {'terms': {'field': 'projects'}}}]
 
-    s = Search(using=es_conn, index=index)  # Index selection
+    # Projects are paginated, so none is left out however many there are
+    return [bucket["key"]["project"] for bucket in composite_buckets(s, sources)]
+
+
+def metric_over_time_search(index, metric_name, metric_field, filters = []):
+    ''' Build the search of a metric by gender and quarter '''
+
+    s = Search(index=index)  # Index selection
     for filtering in filters:
         s = s.filter(filtering)
     s.aggs.bucket('time', 'date_histogram', field='date', interval='quarter', min_doc_count=0) \
           .bucket('gender', 'terms', field='gender', min_doc_count=0) \
           .metric(metric_name, 'cardinality', field=metric_field, precision_threshold=10000)
-    result = s.execute()
-
-    value = result.to_dict()["aggregations"]['time']['buckets']
-    df = pandas.DataFrame()
-    for i in value:
-        df2 = (pandas.DataFrame.from_dict(i["gender"]["buckets"]))
-        df2["time"] = datetime.fromtimestamp(i["key"]/1000).strftime("%Y-%m-%d")
-        try:
-            df2[metric_name] = df2[metric_name].apply(lambda row:row["value"])
-        except:
-            print ("ERROR FOUND!")
-            df2[metric_name] = 0
-        df = pandas.concat([df, df2])
-    df["gender"] = df["key"]
+    return s
+
+
+def flatten_buckets(aggregations, levels, metric_name=None):
+    ''' Flatten nested bucket aggregations into a tidy dataframe
+
+    The buckets are walked once and the dataframe is built at the end,
+    with a row per innermost bucket. Rows have a column per level with
+    the keys of the buckets they belong to, the number of documents and,
+    when given, the value of the metric (0 if missing).
+
+    :param aggregations: aggregations of a response
+    :param levels: names of the nested bucket aggregations, outermost first
+    :param metric_name: name of the metric of the innermost buckets
+
+    :type aggregations: dict
+    :type levels: list of strings
+    :type metric_name: string
+    '''
+
+    columns = {level: [] for level in levels}
+    columns["doc_count"] = []
+    if metric_name:
+        columns[metric_name] = []
+
+    last = len(levels) - 1
+    pending = deque([(aggregations, ())])
+
+    while pending:
+        aggs, keys = pending.popleft()
+        depth = len(keys)
+
+        for bucket in aggs[levels[depth]]["buckets"]:
+            if depth < last:
+                pending.append((bucket, keys + (bucket["key"],)))
+                continue
+
+            for level, key in zip(levels, keys + (bucket["key"],)):
+                columns[level].append(key)
+            columns["doc_count"].append(bucket["doc_count"])
+            if metric_name:
+                columns[metric_name].append(bucket.get(metric_name, {}).get("value") or 0)
+
+    return pandas.DataFrame(columns, columns=list(columns))
+
+
+def by_gender(df, column):
+    ''' Pivot a column of a metric over time into a time x gender frame
+
+    Quarters where a gender has no bucket are filled with 0.
+    '''
+
+    wide = df.pivot(index="key_as_string", columns="gender", values=column)
+    return wide.reindex(columns=GENDERS).fillna(0)
+
+
+def parse_metric_over_time(result, metric_name):
+    ''' Build the dataframe of a metric by gender and quarter from its response '''
+
+    df = flatten_buckets(result.to_dict()["aggregations"], ["time", "gender"], metric_name)
+
+    # Dates of the quarters in local time, as the charts always showed them
+    df["time"] = [datetime.fromtimestamp(key / 1000).strftime("%Y-%m-%d")
+                  for key in df["time"]]
     df["key_as_string"] = df["time"]
     return df
 
 
-def query_total_changesets(index, metric_name, metric_field, filters = []):
-    s = Search(using=es_conn, index=index)  # Index selection
+def query_metric_over_time(index, metric_name, metric_field, filters = []):
+    batch = QueryBatch()
+    batch.metric_over_time(metric_name, index, metric_name, metric_field, filters)
+    return batch.execute()[metric_name]
+
+
+def total_changesets_search(index, metric_name, metric_field, filters = []):
+    ''' Build the search of the total of a metric by gender '''
+
+    s = Search(index=index)  # Index selection
     for filtering in filters:
         s = s.filter(filtering)
     #s = s.filter('range', date={'gt': start_date, 'lt':'now/M'}) # filter date
     s.aggs.bucket('gender', 'terms', field='gender')          .metric(metric_name, 'cardinality', field=metric_field, precision_threshold=10000)
-    result = s.execute()
+    return s
+
+
+def parse_total_changesets(result, metric_name):
+    ''' Get the labels and values of the pie chart of a metric from its response '''
+
+    df = flatten_buckets(result.to_dict()["aggregations"], ["gender"], metric_name)
+    return list(df["gender"]), list(df[metric_name])
+
+
+def query_total_changesets(index, metric_name, metric_field, filters = []):
+    batch = QueryBatch()
+    batch.total_changesets(metric_name, index, metric_name, metric_field, filters)
+    return batch.execute()[metric_name]
+
+
+class QueryBatch:
+    ''' Queue of metric queries sent together with multi-search requests
+
+    Queries are added with a name and run with `execute`, which sends
+    them in groups of `size` searches per `_msearch` request and returns
+    a dict with the parsed result of each name. Metrics found in the
+    rollup are answered from it, and responses found in the cache are
+    not requested again.
+
+    :param size: maximum number of searches per request
+    :param cache: QueryCache used; `query_cache` by default
+    :param rollup: GenderRollup used; `query_rollup` by default
+    '''
+
+    def __init__(self, size=20, cache=None, rollup=None):
+        self.size = size
+        self.cache = cache if cache is not None else query_cache
+        self.rollup = rollup if rollup is not None else query_rollup
+        self.queries = []
+        self.answered = {}
+
+    def metric_over_time(self, name, index, metric_name, metric_field, filters = []):
+        if self.rollup:
+            df = self.rollup.metric_over_time(index, metric_name, metric_field, filters)
+            if df is not None:
+                self.answered[name] = df
+                return
+
+        s = metric_over_time_search(index, metric_name, metric_field, filters)
+        self.add(name, s, lambda result: parse_metric_over_time(result, metric_name))
+
+    def total_changesets(self, name, index, metric_name, metric_field, filters = []):
+        if self.rollup:
+            totals = self.rollup.total_changesets(index, metric_name, metric_field, filters)
+            if totals is not None:
+                self.answered[name] = totals
+                return
+
+        s = total_changesets_search(index, metric_name, metric_field, filters)
+        self.add(name, s, lambda result: parse_total_changesets(result, metric_name))
+
+    def add(self, name, search, parser):
+        self.queries.append((name, search, parser))
 
-    buckets = result.to_dict()["aggregations"]["gender"]["buckets"]
-    pie_chart_labels = []
-    pie_chart_values = []
-    for bucket in buckets:
-        pie_chart_labels.append(bucket["key"])
-        pie_chart_values.append(bucket[metric_name]["value"])
+    def execute(self):
+        results = self.answered
+        pending = []
 
-    return pie_chart_labels, pie_chart_values
+        for name, search, parser in self.queries:
+            cached = self.cache.get(search._index, search.to_dict()) if self.cache else None
+
+            if cached is not None:
+                results[name] = parser(Response(search, cached))
+            else:
+                pending.append((name, search, parser))
+
+        for start in range(0, len(pending), self.size):
+            queries = pending[start:start + self.size]
+
+            ms = MultiSearch(using=ESConnection())
+            for name, search, parser in queries:
+                ms = ms.add(search)
+
+            for (name, search, parser), result in zip(queries, ms.execute()):
+                if self.cache:
+                    self.cache.put(search._index, search.to_dict(), result.to_dict())
+                results[name] = parser(result)
+
+        self.queries = []
+        self.answered = {}
+        return results
 
 
 # # GERRIT
 
-def gerrit_info(project):
-    #filter_project = Q('term', projects=project)
-    #project_name = project
-    project_name = ""
-    filter_project = Q()
+def gerrit_info(project, renderer, output_dir=None):
+    filter_project = Q('term', projects=project) if project else Q()
 
     INDEX = "gerrit_eventized"
     filter_date_4y = Q('range', date={'gt': 'now/M-4y', 'lt':'now/M'})
     filter_date_1y = Q('range', date={'gt': 'now/M-1y', 'lt':'now/M'})
+    filter_vote = Q('term', eventtype='CHANGESET_PATCHSET_APPROVAL_Code-Review') # filter by event: vote a code review
+    filter_core_vote = Q('terms', value=["2", "-2"])
+
+    # All the queries of the report are sent at once
+    batch = QueryBatch()
+    batch.metric_over_time("changesets", INDEX, "changesets", "id", [filter_date_4y, filter_project])
+    batch.total_changesets("changesets_4y", INDEX, "changesets", "id", [filter_date_4y, filter_project])
+    batch.total_changesets("changesets_1y", INDEX, "changesets", "id", [filter_date_1y, filter_project])
+    batch.metric_over_time("submitters", INDEX, "submitters", "uuid", [filter_date_4y, filter_project])
+    batch.total_changesets("submitters_4y", INDEX, "submitters", "uuid", [filter_date_4y, filter_project])
+    batch.total_changesets("submitters_1y", INDEX, "submitters", "uuid", [filter_date_1y, filter_project])
+    batch.metric_over_time("reviewer", INDEX, "reviewer", "uuid", [filter_date_4y, filter_vote, filter_project])
+    batch.metric_over_time("core_reviewers", INDEX, "core_reviewers", "uuid",
+                           [filter_core_vote, filter_date_4y, filter_vote, filter_project])
+    results = batch.execute()
 
 
     # ## Changeset Submissions by Gender
@@ -213,37 +418,35 @@ def gerrit_info(project):
     # 
 
     METRIC_NAME = "changesets"
-    METRIC_FIELD = "id"
-    df = query_metric_over_time(INDEX, METRIC_NAME, METRIC_FIELD, [filter_date_4y, filter_project])
+    df = results["changesets"]
 
 
     chart_title = "Changeset Submissions by Gender"
-    x_data = df[df["gender"]=="female"]["key_as_string"]
-    y_data = [df[df["gender"]=="male"][METRIC_NAME],
-              df[df["gender"]=="female"][METRIC_NAME],
-              df[df["gender"]=="NotKnown"][METRIC_NAME]]
+    wide = by_gender(df, METRIC_NAME)
+    x_data = wide.index
+    y_data = [wide["male"], wide["female"], wide["NotKnown"]]
     y_legend = ["male", "female", "Unknown"]
-    file_name = project_name + "openstack_changeset_submissions_by_gender"
+    file_name = "openstack_changeset_submissions_by_gender"
 
-    evol_chart(chart_title, x_data, y_data, y_legend, file_name)
+    renderer.evol_chart(chart_title, x_data, y_data, y_legend, file_name, output_dir=output_dir)
 
 
 # ### Aggregated changeset submissions by gender
 
-    pie_chart_labels, pie_chart_values = query_total_changesets(INDEX, METRIC_NAME, METRIC_FIELD, [filter_date_4y, filter_project])
+    pie_chart_labels, pie_chart_values = results["changesets_4y"]
 
     total = np.array(pie_chart_values).sum()
     values = list((np.array(pie_chart_values) / total ) * 100)
     title = "Changeset Submissions by Gender (last 4 years)"
-    pie_chart(title, pie_chart_labels, values, project_name + "openstack_piechart_changeset_submissions_by_gender_4y")
+    renderer.pie_chart(title, pie_chart_labels, values, "openstack_piechart_changeset_submissions_by_gender_4y", output_dir=output_dir)
 
 
-    pie_chart_labels, pie_chart_values = query_total_changesets(INDEX, METRIC_NAME, METRIC_FIELD, [filter_date_1y, filter_project])
+    pie_chart_labels, pie_chart_values = results["changesets_1y"]
 
     total = np.array(pie_chart_values).sum()
     values = list((np.array(pie_chart_values) / total ) * 100)
     title = "Changeset Submissions by Gender (last year)"
-    pie_chart(title, pie_chart_labels, values, project_name + "openstack_piechart_changeset_submissions_by_gender_1y")
+    renderer.pie_chart(title, pie_chart_labels, values, "openstack_piechart_changeset_submissions_by_gender_1y", output_dir=output_dir)
 
 
 # ## Population of people submitting changesets
@@ -251,61 +454,55 @@ def gerrit_info(project):
 #   * Count people submitting (id, uuid)
 
     METRIC_NAME = "submitters"
-    METRIC_FIELD = "uuid"
-    df = query_metric_over_time(INDEX, METRIC_NAME, METRIC_FIELD, [filter_date_4y, filter_project])
+    df = results["submitters"]
 
     chart_title = "Changeset submitters by gender"
-    x_data = df[df["gender"]=="female"]["key_as_string"]
-    y_data = [df[df["gender"]=="male"][METRIC_NAME],
-              df[df["gender"]=="female"][METRIC_NAME],
-              df[df["gender"]=="NotKnown"][METRIC_NAME]]
+    wide = by_gender(df, METRIC_NAME)
+    x_data = wide.index
+    y_data = [wide["male"], wide["female"], wide["NotKnown"]]
     y_legend = ["male", "female", "Unknown"]
-    file_name = project_name + "openstack_changeset_submitters_by_gender"
+    file_name = "openstack_changeset_submitters_by_gender"
 
-    evol_chart(chart_title, x_data, y_data, y_legend, file_name)
+    renderer.evol_chart(chart_title, x_data, y_data, y_legend, file_name, output_dir=output_dir)
 
 
 # ### Aggregated number of submitters
 # 
 
-    pie_chart_labels, pie_chart_values = query_total_changesets(INDEX, METRIC_NAME, METRIC_FIELD, [filter_date_4y, filter_project])
+    pie_chart_labels, pie_chart_values = results["submitters_4y"]
     total = np.array(pie_chart_values).sum()
     values = list((np.array(pie_chart_values) / total ) * 100)
     title = "Developers submitting changesets by Gender (last 4 years)"
-    pie_chart(title, pie_chart_labels, values, project_name + "openstack_piechart_changeset_submitters_by_gender_4y")
+    renderer.pie_chart(title, pie_chart_labels, values, "openstack_piechart_changeset_submitters_by_gender_4y", output_dir=output_dir)
 
 
 # * Evolution of code reviews developers over time by gender
 #   * Count people voting (name, uuid, vote)
 # 
 
-    pie_chart_labels, pie_chart_values = query_total_changesets(INDEX, METRIC_NAME, METRIC_FIELD,  [filter_date_1y, filter_project])
+    pie_chart_labels, pie_chart_values = results["submitters_1y"]
     total = np.array(pie_chart_values).sum()
     values = list((np.array(pie_chart_values) / total ) * 100)
     title = "Developers submitting changesets by Gender (last year)"
-    pie_chart(title, pie_chart_labels, values, project_name + "openstack_piechart_changeset_submitters_by_gender_1y")
+    renderer.pie_chart(title, pie_chart_labels, values, "openstack_piechart_changeset_submitters_by_gender_1y", output_dir=output_dir)
 
 
 # ## Number of votes by gender
 
     METRIC_NAME = "reviewer"
-    METRIC_FIELD = "uuid"
-    filter_vote = Q('term', eventtype='CHANGESET_PATCHSET_APPROVAL_Code-Review') # filter by event: vote a code review
-
-    df = query_metric_over_time(INDEX, METRIC_NAME, METRIC_FIELD, [filter_date_4y, filter_vote, filter_project])
+    df = results["reviewer"]
 
 
 # In[423]:
 
     chart_title = "Code review votes by gender"
-    x_data = df[df["gender"]=="female"]["key_as_string"]
-    y_data = [df[df["gender"]=="male"]["doc_count"],
-              df[df["gender"]=="female"]["doc_count"],
-              df[df["gender"]=="NotKnown"]["doc_count"]]
+    wide = by_gender(df, "doc_count")
+    x_data = wide.index
+    y_data = [wide["male"], wide["female"], wide["NotKnown"]]
     y_legend = ["male", "female", "Unknown"]
-    file_name = project_name + "openstack_code_review_votes_by_gender"
+    file_name = "openstack_code_review_votes_by_gender"
 
-    evol_chart(chart_title, x_data, y_data, y_legend, file_name)
+    renderer.evol_chart(chart_title, x_data, y_data, y_legend, file_name, output_dir=output_dir)
 
 
 # ## Number of people voting
@@ -313,14 +510,13 @@ def gerrit_info(project):
 # In[424]:
 
     chart_title = "Code reviewers voting by gender"
-    x_data = df[df["gender"]=="female"]["key_as_string"]
-    y_data = [df[df["gender"]=="male"][METRIC_NAME],
-              df[df["gender"]=="female"][METRIC_NAME],
-              df[df["gender"]=="NotKnown"][METRIC_NAME]]
+    wide = by_gender(df, METRIC_NAME)
+    x_data = wide.index
+    y_data = [wide["male"], wide["female"], wide["NotKnown"]]
     y_legend = ["male", "female", "Unknown"]
-    file_name = project_name + "openstack_code_reviewers_voting_by_gender"
+    file_name = "openstack_code_reviewers_voting_by_gender"
 
-    evol_chart(chart_title, x_data, y_data, y_legend, file_name)
+    renderer.evol_chart(chart_title, x_data, y_data, y_legend, file_name, output_dir=output_dir)
 
 
 # ## Number of core reviews (-2 OR +2) by gender
@@ -328,24 +524,19 @@ def gerrit_info(project):
 # In[425]:
 
     METRIC_NAME = "core_reviewers"
-    METRIC_FIELD = "uuid"
-
-    filter_core_vote = Q('terms', value=["2", "-2"])
-    filter_vote = Q('term', eventtype='CHANGESET_PATCHSET_APPROVAL_Code-Review') # filter by event: vote a code review
-    df = query_metric_over_time(INDEX, METRIC_NAME, METRIC_FIELD, [filter_core_vote, filter_date_4y, filter_vote, filter_project])
+    df = results["core_reviewers"]
 
 
 # In[426]:
 
     chart_title = "Core code reviewes by gender"
-    x_data = df[df["gender"]=="female"]["key_as_string"]
-    y_data = [df[df["gender"]=="male"]["doc_count"],
-              df[df["gender"]=="female"]["doc_count"],
-              df[df["gender"]=="NotKnown"]["doc_count"]]
+    wide = by_gender(df, "doc_count")
+    x_data = wide.index
+    y_data = [wide["male"], wide["female"], wide["NotKnown"]]
     y_legend = ["male", "female", "Unknown"]
-    file_name = project_name + "openstack_core_code_reviews_by_gender"
+    file_name = "openstack_core_code_reviews_by_gender"
 
-    evol_chart(chart_title, x_data, y_data, y_legend, file_name)
+    renderer.evol_chart(chart_title, x_data, y_data, y_legend, file_name, output_dir=output_dir)
 
 
 # ## Number of people acting as core reviews (-2 OR +2) by gender
@@ -353,34 +544,51 @@ def gerrit_info(project):
 # In[427]:
 
     chart_title = "Core code reviewers voting by gender"
-    x_data = df[df["gender"]=="female"]["key_as_string"]
-    y_data = [df[df["gender"]=="male"][METRIC_NAME],
-              df[df["gender"]=="female"][METRIC_NAME],
-              df[df["gender"]=="NotKnown"][METRIC_NAME]]
+    wide = by_gender(df, METRIC_NAME)
+    x_data = wide.index
+    y_data = [wide["male"], wide["female"], wide["NotKnown"]]
     y_legend = ["male", "female", "Unknown"]
-    file_name = project_name + "openstack_core_code_reviewers_voting_by_gender"
+    file_name = "openstack_core_code_reviewers_voting_by_gender"
 
-    evol_chart(chart_title, x_data, y_data, y_legend, file_name)
+    renderer.evol_chart(chart_title, x_data, y_data, y_legend, file_name, output_dir=output_dir)
 
 
 # # GIT
 
-def git_info(project):
+def git_info(project, renderer, output_dir=None):
 # In[446]:
     filter_date_4y = Q('range', date={'gt': 'now/M-4y', 'lt':'now/M'})
     filter_date_1y = Q('range', date={'gt': 'now/M-1y', 'lt':'now/M'})
 
 
-    #project_name = project
-    #filter_project = Q('term', projects=project)
-    project_name = ""
-    filter_project = Q()
+    filter_project = Q('term', projects=project) if project else Q()
 
 
     INDEX = "git_eventized"
     filter_merges_addedlines = Q('range', addedlines={'gt': 0})
     filter_merges_removedlines = Q('range', removedlines={'gt': 0})
     filter_bots = Q('bool', must_not=[Q('match', gender_analyzed_name='Jenkins')])
+    filter_code = Q('term', filetype='code')
+    filter_other = Q('term', filetype='other')
+
+    filters_4y = [filter_date_4y, filter_merges_addedlines, filter_merges_removedlines,
+                  filter_bots, filter_project]
+    filters_1y = [filter_date_1y, filter_merges_addedlines, filter_merges_removedlines,
+                  filter_bots, filter_project]
+
+    # All the queries of the report are sent at once
+    batch = QueryBatch()
+    batch.metric_over_time("commits", INDEX, "commits", "id.keyword", filters_4y)
+    batch.total_changesets("commits_4y", INDEX, "commits", "id.keyword", filters_4y)
+    batch.total_changesets("commits_1y", INDEX, "commits", "id.keyword", filters_1y)
+    batch.metric_over_time("authors", INDEX, "authors", "uuid", filters_4y)
+    batch.total_changesets("authors_4y", INDEX, "authors", "uuid", filters_4y)
+    batch.total_changesets("authors_1y", INDEX, "authors", "uuid", filters_1y)
+    batch.metric_over_time("code_files_touched", INDEX, "code_files_touched", "id.keyword",
+                           filters_4y + [filter_code])
+    batch.metric_over_time("others_files_touched", INDEX, "others_files_touched", "id.keyword",
+                           filters_4y + [filter_other])
+    results = batch.execute()
 
 
 # ## Evolution and trends over time [per quarter] of commits by gender
@@ -389,45 +597,35 @@ def git_info(project):
 # In[447]:
 
     METRIC_NAME = "commits"
-    METRIC_FIELD = "id.keyword"
-    df = query_metric_over_time(INDEX, METRIC_NAME, METRIC_FIELD, [filter_date_4y, filter_merges_addedlines,
-                                                                   filter_merges_removedlines, filter_bots,
-                                                                   filter_project])
+    df = results["commits"]
 
 # In[448]:
     chart_title = "Commits by gender"
-    x_data = df[df["gender"]=="female"]["key_as_string"]
-    y_data = [df[df["gender"]=="male"][METRIC_NAME],
-              df[df["gender"]=="female"][METRIC_NAME],
-              df[df["gender"]=="NotKnown"][METRIC_NAME]]
+    wide = by_gender(df, METRIC_NAME)
+    x_data = wide.index
+    y_data = [wide["male"], wide["female"], wide["NotKnown"]]
     y_legend = ["male", "female", "Unknown"]
-    file_name = project_name + "openstack_commits_by_gender"
+    file_name = "openstack_commits_by_gender"
 
-    evol_chart(chart_title, x_data, y_data, y_legend, file_name)
+    renderer.evol_chart(chart_title, x_data, y_data, y_legend, file_name, output_dir=output_dir)
 
 
 # In[449]:
 
-    pie_chart_labels, pie_chart_values = query_total_changesets(INDEX, METRIC_NAME, METRIC_FIELD,
-                                                                [filter_date_4y, filter_merges_addedlines,
-                                                                 filter_merges_removedlines, filter_bots,
-                                                                 filter_project])
+    pie_chart_labels, pie_chart_values = results["commits_4y"]
     total = np.array(pie_chart_values).sum()
     values = list((np.array(pie_chart_values) / total ) * 100)
     title = "Commits by Gender (last 4 years)"
-    pie_chart(title, pie_chart_labels, values, project_name + "openstack_piechart_commits_by_gender_4years")
+    renderer.pie_chart(title, pie_chart_labels, values, "openstack_piechart_commits_by_gender_4years", output_dir=output_dir)
 
 
 # In[450]:
 
-    pie_chart_labels, pie_chart_values = query_total_changesets(INDEX, METRIC_NAME, METRIC_FIELD,
-                                                                [filter_date_1y, filter_merges_addedlines,
-                                                                 filter_merges_removedlines, filter_bots,
-                                                                 filter_project])
+    pie_chart_labels, pie_chart_values = results["commits_1y"]
     total = np.array(pie_chart_values).sum()
     values = list((np.array(pie_chart_values) / total ) * 100)
     title = "Commits by Gender (last year)"
-    pie_chart(title, pie_chart_labels, values, project_name + "openstack_piechart_commits_by_gender_1year")
+    renderer.pie_chart(title, pie_chart_labels, values, "openstack_piechart_commits_by_gender_1year", output_dir=output_dir)
 
 
 # 
@@ -437,51 +635,38 @@ def git_info(project):
 # In[431]:
 
     METRIC_NAME = "authors"
-    METRIC_FIELD = "uuid"
-    filter_merges_addedlines = Q('range', addedlines={'gt': 0})
-    filter_merges_removedlines = Q('range', removedlines={'gt': 0})
-    filter_bots = Q('bool', must_not=[Q('match', gender_analyzed_name='Jenkins')])
-    df = query_metric_over_time(INDEX, METRIC_NAME, METRIC_FIELD, [filter_date_4y, filter_merges_addedlines,
-                                                                   filter_merges_removedlines, filter_bots,
-                                                                   filter_project])
+    df = results["authors"]
 
 
 
 # In[432]:
 
     chart_title = "Developers submitting commits"
-    x_data = df[df["gender"]=="female"]["key_as_string"]
-    y_data = [df[df["gender"]=="male"][METRIC_NAME],
-              df[df["gender"]=="female"][METRIC_NAME],
-              df[df["gender"]=="NotKnown"][METRIC_NAME]]
+    wide = by_gender(df, METRIC_NAME)
+    x_data = wide.index
+    y_data = [wide["male"], wide["female"], wide["NotKnown"]]
     y_legend = ["male", "female", "Unknown"]
-    file_name = project_name + "openstack_developers_submitting_commits_by_gender"
+    file_name = "openstack_developers_submitting_commits_by_gender"
 
-    evol_chart(chart_title, x_data, y_data, y_legend, file_name)
+    renderer.evol_chart(chart_title, x_data, y_data, y_legend, file_name, output_dir=output_dir)
 
 
 # In[452]:
 
-    pie_chart_labels, pie_chart_values = query_total_changesets(INDEX, METRIC_NAME, METRIC_FIELD,
-                                                                [filter_date_4y, filter_merges_addedlines,
-                                                                 filter_merges_removedlines, filter_bots,
-                                                                 filter_project])
+    pie_chart_labels, pie_chart_values = results["authors_4y"]
     total = np.array(pie_chart_values).sum()
     values = list((np.array(pie_chart_values) / total ) * 100)
     title = "Developers committing changes by Gender (last 4 years)"
-    pie_chart(title, pie_chart_labels, values, project_name + "openstack_piechart_developers_submitting_commits_by_gender_4years")
+    renderer.pie_chart(title, pie_chart_labels, values, "openstack_piechart_developers_submitting_commits_by_gender_4years", output_dir=output_dir)
 
 
 # In[454]:
 
-    pie_chart_labels, pie_chart_values = query_total_changesets(INDEX, METRIC_NAME, METRIC_FIELD,
-                                                                [filter_date_1y, filter_merges_addedlines,
-                                                                 filter_merges_removedlines, filter_bots,
-                                                                 filter_project])
+    pie_chart_labels, pie_chart_values = results["authors_1y"]
     total = np.array(pie_chart_values).sum()
     values = list((np.array(pie_chart_values) / total ) * 100)
     title = "Developers committing changes by Gender (last years)"
-    pie_chart(title, pie_chart_labels, values, project_name + "openstack_piechart_developers_submitting_commits_by_gender_1year")
+    renderer.pie_chart(title, pie_chart_labels, values, "openstack_piechart_developers_submitting_commits_by_gender_1year", output_dir=output_dir)
 
 
 # ## Evolution and trends of type of contributions (code or others) by gender over time
@@ -491,69 +676,134 @@ def git_info(project):
 # In[433]:
 
     METRIC_NAME = "code_files_touched"
-    METRIC_FIELD = "id.keyword"
-    filter_merges_addedlines = Q('range', addedlines={'gt': 0})
-    filter_merges_removedlines = Q('range', removedlines={'gt': 0})
-    filter_bots = Q('bool', must_not=[Q('match', gender_analyzed_name='Jenkins')])
-    filter_filetype = Q('term', filetype='code')
-    df = query_metric_over_time(INDEX, METRIC_NAME, METRIC_FIELD, [filter_date_4y, filter_merges_addedlines,
-                                                                   filter_merges_removedlines, filter_bots,
-                                                                   filter_filetype, filter_project])
+    df = results["code_files_touched"]
 
 
 
 # In[434]:
 
     chart_title = "Code files touched by gender"
-    x_data = df[df["gender"]=="female"]["key_as_string"]
-    y_data = [df[df["gender"]=="male"]["doc_count"],
-              df[df["gender"]=="female"]["doc_count"],
-              df[df["gender"]=="NotKnown"]["doc_count"]]
+    wide = by_gender(df, "doc_count")
+    x_data = wide.index
+    y_data = [wide["male"], wide["female"], wide["NotKnown"]]
     y_legend = ["male", "female", "Unknown"]
-    file_name = project_name + "openstack_code_files_touched_by_gender"
+    file_name = "openstack_code_files_touched_by_gender"
 
-    evol_chart(chart_title, x_data, y_data, y_legend, file_name)
+    renderer.evol_chart(chart_title, x_data, y_data, y_legend, file_name, output_dir=output_dir)
 
 
 # In[435]:
 
     METRIC_NAME = "others_files_touched"
-    METRIC_FIELD = "id.keyword"
-    filter_merges_addedlines = Q('range', addedlines={'gt': 0})
-    filter_merges_removedlines = Q('range', removedlines={'gt': 0})
-    filter_bots = Q('bool', must_not=[Q('match', gender_analyzed_name='Jenkins')])
-    filter_filetype = Q('term', filetype='other')
-    df = query_metric_over_time(INDEX, METRIC_NAME, METRIC_FIELD, [filter_date_4y, filter_merges_addedlines,
-                                                                   filter_merges_removedlines, filter_bots,
-                                                                   filter_filetype, filter_project])
+    df = results["others_files_touched"]
 
 
 
 # In[436]:
 
     chart_title = "Non code files touched by gender"
-    x_data = df[df["gender"]=="female"]["key_as_string"]
-    y_data = [df[df["gender"]=="male"]["doc_count"],
-              df[df["gender"]=="female"]["doc_count"],
-              df[df["gender"]=="NotKnown"]["doc_count"]]
+    wide = by_gender(df, "doc_count")
+    x_data = wide.index
+    y_data = [wide["male"], wide["female"], wide["NotKnown"]]
     y_legend = ["male", "female", "Unknown"]
-    file_name = project_name + "openstack_non_code_files_touched_by_gender"
+    file_name = "openstack_non_code_files_touched_by_gender"
+
+    renderer.evol_chart(chart_title, x_data, y_data, y_legend, file_name, output_dir=output_dir)
+
+
+
+def project_report(project, pool, output_dir):
+    ''' Run the git and gerrit reports of a project
+
+    :param project: name of the project
+    :param pool: ProcessPoolExecutor where charts are rendered
+    :param output_dir: base directory; charts are saved in a
+        subdirectory named after the project
+
+    :returns: the ChartRenderer with the charts of the project
+    '''
+
+    project_dir = os.path.join(output_dir, project.replace("/", "_"))
+    os.makedirs(project_dir, exist_ok=True)
+
+    renderer = ChartRenderer(pool, project_dir)
+    git_info(project, renderer, project_dir)
+    gerrit_info(project, renderer, project_dir)
+
+    return renderer
+
+
+def parse_args():
+    parser = ArgumentParser(usage="Usage: '%(prog)s [options]")
 
-    evol_chart(chart_title, x_data, y_data, y_legend, file_name)
+    parser.add_argument('-o', '--output-dir', dest='output_dir', default='/tmp/openstack-diversity',
+                        help='Directory where the charts of each project are saved')
+    parser.add_argument('-p', '--project', dest='projects', action='append', default=None,
+                        help='Project to report; all of them by default')
+    parser.add_argument('-w', '--workers', dest='workers', type=int, default=8,
+                        help='Number of projects reported at the same time')
+    parser.add_argument('--processes', dest='processes', type=int, default=None,
+                        help='Number of processes used to render charts')
+    parser.add_argument('--rollup', dest='rollup', default=None,
+                        help='File built by rollup.py; metrics found in it are not queried')
 
+    return parser.parse_args()
 
 
 def main():
-   for project in project_list('gerrit_eventized'):
-       if project == 'Unknown':
-           continue
-       print (project)
-       git_info(project)
-       print ("git info ready to go")
-       gerrit_info(project)
-       print ("gerrit info ready to go")
-
-       break
+   global query_cache, query_rollup
+
+   args = parse_args()
+
+   query_cache = QueryCache(os.path.join(tempfile.gettempdir(), "openstack-diversity-cache"))
+   if args.rollup:
+       query_rollup = GenderRollup.load(args.rollup)
+   pool = ProcessPoolExecutor(max_workers=args.processes)
+   rendered = 0
+   start = time.time()
+
+   try:
+       projects = args.projects or [project for project in project_list('gerrit_eventized')
+                                    if project != 'Unknown']
+
+       # The ES client is thread safe; its pool should be at least as
+       # large as the number of workers
+       with ThreadPoolExecutor(max_workers=args.workers) as executor:
+           futures = {executor.submit(project_report, project, pool, args.output_dir): project
+                      for project in projects}
+           failed = []
+
+           # A project that fails, in its queries or in its charts,
+           # doesn't stop the report of the rest
+           for done, future in enumerate(as_completed(futures), 1):
+               project = futures[future]
+               renderer = None
+               try:
+                   renderer = future.result()
+                   renderer.wait()
+               except Exception as e:
+                   failed.append(project)
+                   print ("[%d/%d] %s failed: %r" % (done, len(projects), project, e))
+                   continue
+               finally:
+                   rendered += renderer.rendered if renderer else 0
+               elapsed = time.time() - start
+               print ("[%d/%d] %s ready to go (%.2f projects/min)" % \
+                      (done, len(projects), project, done / elapsed * 60))
+
+           if failed:
+               print ("%d projects failed: %s" % (len(failed), ", ".join(failed)))
+   finally:
+       try:
+           # Charts of the projects whose queries failed are still
+           # rendered before leaving
+           pool.shutdown()
+           print ("%d charts rendered in %.2fs" % (rendered, time.time() - start))
+       finally:
+           try:
+               print (query_cache.report())
+           finally:
+               close_connection()
 
 if __name__== '__main__':
     main()
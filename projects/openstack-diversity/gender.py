@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+''' Retrieve, store and update the gender information of the developers
+
+Script version of the 'Retrieve Store gender info' and 'Updating in
+ElasticSearch Gender' notebooks. The owners of an index and their
+gender are read page by page with a composite aggregation and written
+to a TSV or Parquet file, so the export takes the same memory whatever
+the number of owners. A TSV gender table can then be used to enrich the
+documents of an index, either copying them to another index with
+parallel bulk requests or updating them in place by query.
+'''
+
+import time
+
+from argparse import ArgumentParser
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from elasticsearch import helpers
+from elasticsearch_dsl import Search, UpdateByQuery
+
+from util import ESConnection, close_connection, composite_buckets
+
+SEP = "\t"
+
+# Fields of the gender table, in file order
+GENDER_FIELDS = ['owner', 'gender_analyzed_name', 'gender', 'gender_probability']
+
+GENDER_SOURCES = [{'owner': {'terms': {'field': 'owner'}}},
+                  {'gender_analyzed_name': {'terms': {'field': 'gender_analyzed_name.keyword'}}},
+                  {'gender': {'terms': {'field': 'gender'}}},
+                  {'gender_probability': {'terms': {'field': 'gender_probability'}}}]
+
+
+def gender_rows(index, page_size=1000):
+    ''' Iterate over the gender information of the owners of an index
+
+    Buckets are sorted by owner, so the combinations of name, gender and
+    probability of an owner come together. The one found in more
+    documents is chosen for each owner.
+
+    :param index: name of the index
+    :param page_size: number of buckets requested at once
+    '''
+
+    s = Search(using=ESConnection(), index=index)
+
+    current = None
+    count = 0
+
+    for bucket in composite_buckets(s, GENDER_SOURCES, size=page_size):
+        key = bucket['key']
+
+        if current is not None and key['owner'] == current['owner']:
+            if bucket['doc_count'] > count:
+                current, count = key, bucket['doc_count']
+            continue
+
+        if current is not None:
+            yield current
+        current, count = key, bucket['doc_count']
+
+    if current is not None:
+        yield current
+
+
+def export_tsv(rows, path):
+    nrows = 0
+
+    with open(path, "w") as fd:
+        for row in rows:
+            fd.write(SEP.join(str(row[field]) for field in GENDER_FIELDS) + "\n")
+            nrows += 1
+
+    return nrows
+
+
+def export_parquet(rows, path, row_group_size=10000):
+    ''' Write the gender rows to a Parquet file, a row group at a time '''
+
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("pyarrow is required to export to Parquet")
+
+    schema = pyarrow.schema([('owner', pyarrow.string()),
+                             ('gender_analyzed_name', pyarrow.string()),
+                             ('gender', pyarrow.string()),
+                             ('gender_probability', pyarrow.float64())])
+
+    def write(writer, group):
+        arrays = [pyarrow.array([row[field] for row in group], type=schema.field(field).type)
+                  for field in GENDER_FIELDS]
+        writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+
+    nrows = 0
+    group = []
+
+    with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+        for row in rows:
+            group.append(row)
+
+            if len(group) == row_group_size:
+                write(writer, group)
+                nrows += len(group)
+                group = []
+
+        if group or not nrows:
+            write(writer, group)
+            nrows += len(group)
+
+    return nrows
+
+
+def load_gender_table(path, key='owner'):
+    ''' Read a TSV gender table into a dict of name -> (gender, probability)
+
+    :param path: file written by `export_tsv`
+    :param key: field used as name; 'owner' or 'gender_analyzed_name'
+    '''
+
+    table = {}
+
+    with open(path) as fd:
+        for line in fd:
+            row = dict(zip(GENDER_FIELDS, line.rstrip("\n").split(SEP)))
+            table[row[key]] = (row['gender'], float(row['gender_probability']))
+
+    return table
+
+
+def enrich_actions(hits, table, name_field, target_index, doc_type=None):
+    ''' Bulk actions copying the hits with their gender to another index
+
+    Documents whose name is not in the table are copied unchanged.
+    '''
+
+    for hit in hits:
+        source = hit['_source']
+
+        gender = table.get(source.get(name_field))
+        if gender is not None:
+            source['dev_gender'], source['dev_probability'] = gender
+
+        yield {'_index': target_index,
+               '_type': doc_type or hit['_type'],
+               '_id': hit['_id'],
+               '_source': source}
+
+
+def enrich_index(index, table, target_index, name_field='dev_name', doc_type=None,
+                 slices=4, chunk_size=500, max_retries=5, initial_backoff=2):
+    ''' Copy the documents of an index to another adding their gender
+
+    The source index is read with a sliced scroll, a slice per thread,
+    and each thread writes its documents with bulk requests. Chunks
+    rejected because the cluster is busy are retried with exponential
+    backoff.
+
+    :param index: index to read
+    :param table: dict of name -> (gender, probability)
+    :param target_index: index where enriched documents are written
+    :param name_field: field of the documents with the name
+    :param doc_type: type of the new documents; the one read by default
+    :param slices: number of scroll slices and threads
+    :param chunk_size: documents per scroll page and bulk request
+    :param max_retries: times a rejected chunk is retried
+    :param initial_backoff: seconds to wait before the first retry
+
+    :returns: number of documents written and number of errors
+    '''
+
+    es = ESConnection()
+
+    def enrich_slice(slice_id):
+        query = {'slice': {'id': slice_id, 'max': slices}} if slices > 1 else {}
+        hits = helpers.scan(es, query=query, index=index, size=chunk_size)
+        actions = enrich_actions(hits, table, name_field, target_index, doc_type)
+
+        nwritten = nerrors = 0
+
+        for ok, info in helpers.streaming_bulk(es, actions, chunk_size=chunk_size,
+                                               max_retries=max_retries,
+                                               initial_backoff=initial_backoff,
+                                               raise_on_error=False):
+            if ok:
+                nwritten += 1
+            else:
+                nerrors += 1
+                print ("Error writing document: %s" % info)
+
+        return nwritten, nerrors
+
+    with ThreadPoolExecutor(max_workers=slices) as executor:
+        results = list(executor.map(enrich_slice, range(slices)))
+
+    return sum(r[0] for r in results), sum(r[1] for r in results)
+
+
+def update_gender_by_query(index, table, name_field='dev_name', batch_size=1000):
+    ''' Set the gender of the documents of an index in place
+
+    Names are grouped by gender and probability, so a single update by
+    query, run by the cluster in parallel slices, tags every document
+    of up to `batch_size` names.
+
+    :param index: index to update
+    :param table: dict of name -> (gender, probability)
+    :param name_field: keyword field of the documents with the name
+    :param batch_size: names per update by query
+
+    :returns: number of documents updated
+    '''
+
+    es = ESConnection()
+
+    groups = defaultdict(list)
+    for name, gender in table.items():
+        groups[gender].append(name)
+
+    script = "ctx._source.dev_gender = params.gender; " \
+             "ctx._source.dev_probability = params.probability"
+
+    nupdated = 0
+
+    for (gender, probability), names in groups.items():
+        for start in range(0, len(names), batch_size):
+            ubq = UpdateByQuery(using=es, index=index) \
+                .filter('terms', **{name_field: names[start:start + batch_size]}) \
+                .script(source=script, lang='painless',
+                        params={'gender': gender, 'probability': probability}) \
+                .params(conflicts='proceed', slices='auto')
+            response = ubq.execute()
+            nupdated += response.updated
+
+    return nupdated
+
+
+def parse_args():
+    parser = ArgumentParser(usage="Usage: '%(prog)s [options] <command> ...")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    # Export options
+    export = subparsers.add_parser('export', help='Export the gender of the owners of an index')
+    export.add_argument('--format', dest='format', choices=['tsv', 'parquet'], default='tsv',
+                        help='Format of the output file')
+    export.add_argument('--page-size', dest='page_size', type=int, default=1000,
+                        help='Number of owners requested at once')
+    export.add_argument('index', help='Index with the gender information, i.e. git_eventized')
+    export.add_argument('output', help='File where the gender information is written')
+
+    # Enrichment options
+    enrich = subparsers.add_parser('enrich', help='Add the gender of a table to an index')
+    enrich.add_argument('--key', dest='key', choices=['owner', 'gender_analyzed_name'],
+                        default='owner', help='Field of the table used as name')
+    enrich.add_argument('--name-field', dest='name_field', default='dev_name',
+                        help='Field of the documents with the name')
+    enrich.add_argument('--target', dest='target', default=None,
+                        help='Index where enriched documents are copied; '
+                             'when not given, documents are updated in place by query')
+    enrich.add_argument('--doc-type', dest='doc_type', default=None,
+                        help='Type of the copied documents')
+    enrich.add_argument('--threads', dest='threads', type=int, default=4,
+                        help='Number of scroll slices and bulk threads')
+    enrich.add_argument('--chunk-size', dest='chunk_size', type=int, default=500,
+                        help='Number of documents per bulk request')
+    enrich.add_argument('--max-retries', dest='max_retries', type=int, default=5,
+                        help='Number of retries of a rejected bulk request')
+    enrich.add_argument('table', help='TSV gender table')
+    enrich.add_argument('index', help='Index to enrich, i.e. git')
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    start = time.time()
+
+    try:
+        if args.command == 'export':
+            rows = gender_rows(args.index, args.page_size)
+
+            if args.format == 'parquet':
+                nrows = export_parquet(rows, args.output)
+            else:
+                nrows = export_tsv(rows, args.output)
+
+            print ("%d owners exported to %s" % (nrows, args.output))
+        else:
+            table = load_gender_table(args.table, args.key)
+
+            if args.target:
+                nrows, nerrors = enrich_index(args.index, table, args.target, args.name_field,
+                                              args.doc_type, args.threads, args.chunk_size,
+                                              args.max_retries)
+                print ("%d documents copied to %s, %d errors" % (nrows, args.target, nerrors))
+            else:
+                nrows = update_gender_by_query(args.index, table, args.name_field)
+                print ("%d documents of %s updated" % (nrows, args.index))
+    finally:
+        close_connection()
+
+    secs = time.time() - start
+    print ("%.2fs (%.2f rows/sec)" % (secs, nrows / secs if secs else 0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,447 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+''' Pre-aggregated gender metrics of the diversity report
+
+The metrics of the report are counted once by month, project and
+gender, and stored in a local file. Each cell keeps the number of
+documents and a sketch of the distinct values of the metric field,
+which can be merged, so the quarters and date windows of the report
+are computed from the months without querying the raw events.
+
+Months are used instead of quarters because the report windows
+('now/M-4y' to 'now/M') start and end on months. Updates only
+recompute the newest quarter.
+'''
+
+import datetime
+import gzip
+import hashlib
+import json
+import pickle
+import re
+
+from argparse import ArgumentParser
+from collections import defaultdict
+
+import numpy as np
+import pandas
+
+from elasticsearch_dsl import Search, Q
+
+from util import ESConnection, close_connection, composite_buckets
+
+# Values counted exactly before switching to HyperLogLog, as the
+# precision_threshold used by the report
+EXACT_THRESHOLD = 10000
+# 2^14 registers, around 0.8% of error
+PRECISION = 14
+
+# Filters of the metrics of the report. The date and project filters
+# are not part of the metrics; they are applied on the rollup.
+FILTER_VOTE = Q('term', eventtype='CHANGESET_PATCHSET_APPROVAL_Code-Review')
+FILTER_CORE_VOTE = Q('terms', value=["2", "-2"])
+FILTERS_GIT = [Q('range', addedlines={'gt': 0}),
+               Q('range', removedlines={'gt': 0}),
+               Q('bool', must_not=[Q('match', gender_analyzed_name='Jenkins')])]
+
+METRICS = [("gerrit_eventized", "id", []),
+           ("gerrit_eventized", "uuid", []),
+           ("gerrit_eventized", "uuid", [FILTER_VOTE]),
+           ("gerrit_eventized", "uuid", [FILTER_CORE_VOTE, FILTER_VOTE]),
+           ("git_eventized", "id.keyword", FILTERS_GIT),
+           ("git_eventized", "uuid", FILTERS_GIT),
+           ("git_eventized", "id.keyword", FILTERS_GIT + [Q('term', filetype='code')]),
+           ("git_eventized", "id.keyword", FILTERS_GIT + [Q('term', filetype='other')])]
+
+# Key of the cells of all the projects together
+ALL_PROJECTS = ""
+
+
+def hash_values(values):
+    ''' 64 bit hashes of a list of values, stable between runs '''
+
+    hashes = [int.from_bytes(hashlib.blake2b(str(value).encode('utf-8'), digest_size=8).digest(),
+                             'little')
+              for value in values]
+    return np.unique(np.array(hashes, dtype=np.uint64))
+
+
+class DistinctSketch:
+    ''' Mergeable count of distinct values
+
+    Values are kept as sorted 64 bit hashes, which are counted exactly,
+    until there are more than EXACT_THRESHOLD. Then they are folded in
+    the registers of a HyperLogLog. Sketches of both kinds can be merged.
+    '''
+
+    __slots__ = ('hashes', 'registers')
+
+    def __init__(self, hashes=None, registers=None):
+        self.hashes = hashes
+        self.registers = registers
+
+        if self.hashes is not None and len(self.hashes) > EXACT_THRESHOLD:
+            self.registers = self._fold(np.zeros(1 << PRECISION, dtype=np.uint8), self.hashes)
+            self.hashes = None
+
+    @classmethod
+    def from_values(cls, values):
+        return cls(hashes=hash_values(values))
+
+    def merge(self, other):
+        if self.registers is None and other.registers is None:
+            return DistinctSketch(hashes=np.union1d(self.hashes, other.hashes))
+
+        registers = np.zeros(1 << PRECISION, dtype=np.uint8)
+
+        for sketch in (self, other):
+            if sketch.registers is not None:
+                np.maximum(registers, sketch.registers, out=registers)
+            else:
+                self._fold(registers, sketch.hashes)
+
+        return DistinctSketch(registers=registers)
+
+    def count(self):
+        if self.registers is None:
+            return len(self.hashes)
+
+        m = float(len(self.registers))
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int32)))
+
+        zeros = np.count_nonzero(self.registers == 0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * np.log(m / zeros)
+
+        return int(round(estimate))
+
+    @staticmethod
+    def _fold(registers, hashes):
+        index = (hashes >> np.uint64(64 - PRECISION)).astype(np.intp)
+        # A guard bit keeps the rank bounded
+        rest = (hashes << np.uint64(PRECISION)) | np.uint64(1 << (PRECISION - 1))
+
+        # Bit length from the 53 upper bits, which float64 holds exactly
+        upper = rest >> np.uint64(11)
+        length = np.where(upper > 0,
+                          np.frexp(upper.astype(np.float64))[1] + 11,
+                          np.frexp(rest.astype(np.float64))[1])
+        rank = (65 - length).astype(np.uint8)
+
+        np.maximum.at(registers, index, rank)
+        return registers
+
+
+def split_filters(filters):
+    ''' Split the filters of a query in date window, project and the rest '''
+
+    window = None
+    project = ALL_PROJECTS
+    rest = []
+
+    for f in filters:
+        d = f.to_dict()
+
+        if d == {'match_all': {}}:
+            continue
+        elif list(d) == ['range'] and list(d['range']) == ['date']:
+            window = d['range']['date']
+        elif list(d) == ['term'] and list(d['term']) == ['projects']:
+            project = d['term']['projects']
+        else:
+            rest.append(f)
+
+    return window, project, rest
+
+
+def resolve_month(expression, now=None):
+    ''' Month of a date math expression rounded to months, i.e. now/M-4y
+
+    Returns None for expressions not rounded to months.
+    '''
+
+    match = re.match(r'^now/M(?:([+-])(\d+)([yM]))?$', expression)
+    if not match:
+        return None
+
+    now = now or datetime.datetime.utcnow()
+    months = now.year * 12 + now.month - 1
+
+    if match.group(1):
+        delta = int(match.group(2)) * (12 if match.group(3) == 'y' else 1)
+        months += delta if match.group(1) == '+' else -delta
+
+    return "%04d-%02d" % (months // 12, months % 12 + 1)
+
+
+def next_month(month):
+    year, month = month.split("-")
+    return "%04d-%02d" % (int(year) + int(month) // 12, int(month) % 12 + 1)
+
+
+def quarter_of(month):
+    year, month = month.split("-")
+    return "%s-%02d-01" % (year, (int(month) - 1) // 3 * 3 + 1)
+
+
+class GenderRollup:
+    ''' Metrics counted by month, project and gender
+
+    Each metric is identified by its index, field and filters, and
+    answers the queries of the report with the same ones plus a date
+    window and a project.
+    '''
+
+    def __init__(self):
+        # Definitions of the metrics, by key
+        self.metrics = {}
+        # Cells by metric key and project; each one is a dict of
+        # (month, gender) -> [number of documents, DistinctSketch]
+        self.cells = defaultdict(dict)
+
+    @staticmethod
+    def metric_key(index, metric_field, filters):
+        serialized = sorted(json.dumps(f.to_dict(), sort_keys=True) for f in filters)
+        return json.dumps([index, metric_field, serialized])
+
+    @classmethod
+    def load(cls, path):
+        rollup = cls()
+
+        with gzip.open(path, 'rb') as fd:
+            data = pickle.load(fd)
+
+        rollup.metrics = data['metrics']
+        rollup.cells.update(data['cells'])
+        return rollup
+
+    def save(self, path):
+        with gzip.open(path, 'wb') as fd:
+            pickle.dump({'metrics': self.metrics, 'cells': dict(self.cells)}, fd,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+
+    def build(self, index, metric_field, filters, since=None, page_size=1000):
+        ''' Count a metric from the raw events of an index
+
+        :param since: first month counted, as date math (i.e. 'now/M-5y');
+            every month when not given
+        '''
+
+        key = self.metric_key(index, metric_field, filters)
+        self.metrics[key] = {'index': index, 'metric_field': metric_field,
+                             'filters': [f.to_dict() for f in filters]}
+
+        s = Search(using=ESConnection(), index=index)
+        for f in filters:
+            s = s.filter(f)
+        if since:
+            s = s.filter('range', date={'gte': since})
+
+        month = {'month': {'date_histogram': {'field': 'date', 'interval': '1M'}}}
+        gender = {'gender': {'terms': {'field': 'gender'}}}
+        value = {'value': {'terms': {'field': metric_field}}}
+        project = {'project': {'terms': {'field': 'projects'}}}
+
+        # Documents of several projects are counted once in the total
+        self._count(key, s, [month, project, gender, value], page_size)
+        self._count(key, s, [month, gender, value], page_size)
+
+    def update(self, page_size=1000):
+        ''' Recount the newest quarter of every metric '''
+
+        for key, metric in self.metrics.items():
+            months = [month for cells in self._metric_cells(key) for month, gender in cells]
+            if not months:
+                continue
+
+            start = quarter_of(max(months))[:7]
+
+            for project in self._projects(key):
+                cells = self.cells[(key, project)]
+                for cell in [cell for cell in cells if cell[0] >= start]:
+                    del cells[cell]
+
+            filters = [Q(f) for f in metric['filters']]
+            self.build(metric['index'], metric['metric_field'], filters,
+                       since=start + "-01", page_size=page_size)
+
+    def metric_over_time(self, index, metric_name, metric_field, filters):
+        ''' Answer a query_metric_over_time, or None when not in the rollup '''
+
+        answer = self._answer(index, metric_field, filters)
+        if answer is None:
+            return None
+
+        key, cells = answer
+
+        # As terms with min_doc_count=0, every gender of the metric is
+        # given for every quarter
+        genders = sorted({gender for project_cells in self._metric_cells(key)
+                          for month, gender in project_cells})
+
+        by_quarter = self._merge(cells, quarter_of)
+
+        quarters = sorted({quarter for quarter, gender in by_quarter})
+        if quarters:
+            quarters = pandas.date_range(quarters[0], quarters[-1], freq='QS').strftime("%Y-%m-%d")
+
+        rows = []
+        for quarter in quarters:
+            buckets = []
+            for gender in genders:
+                doc_count, sketch = by_quarter.get((quarter, gender), (0, None))
+                buckets.append((quarter, gender, doc_count, sketch.count() if sketch else 0))
+
+            # Ordered as terms buckets, by number of documents
+            rows.extend(sorted(buckets, key=lambda bucket: (-bucket[2], bucket[1])))
+
+        df = pandas.DataFrame(rows, columns=["time", "gender", "doc_count", metric_name])
+        df["key_as_string"] = df["time"]
+        return df
+
+    def total_changesets(self, index, metric_name, metric_field, filters):
+        ''' Answer a query_total_changesets, or None when not in the rollup '''
+
+        answer = self._answer(index, metric_field, filters)
+        if answer is None:
+            return None
+
+        totals = self._merge(answer[1], lambda month: None)
+        genders = sorted(totals, key=lambda k: (-totals[k][0], k[1]))
+
+        return [gender for _, gender in genders], [totals[k][1].count() for k in genders]
+
+    def _answer(self, index, metric_field, filters):
+        window, project, rest = split_filters(filters)
+
+        key = self.metric_key(index, metric_field, rest)
+        if key not in self.metrics:
+            return None
+
+        start, end = None, None
+
+        # Elasticsearch rounds 'gt' and 'lte' up to the end of the
+        # month, and 'gte' and 'lt' down to its start
+        for op, expression in (window or {}).items():
+            month = resolve_month(expression)
+
+            if month is None:
+                return None
+            elif op == 'gt':
+                start = next_month(month)
+            elif op == 'gte':
+                start = month
+            elif op == 'lt':
+                end = month
+            elif op == 'lte':
+                end = next_month(month)
+
+        cells = {cell: value for cell, value in self.cells.get((key, project), {}).items()
+                 if (start is None or cell[0] >= start) and (end is None or cell[0] < end)}
+        return key, cells
+
+    def _merge(self, cells, group):
+        merged = {}
+
+        for (month, gender), (doc_count, sketch) in cells.items():
+            k = (group(month), gender)
+
+            if k in merged:
+                merged[k] = (merged[k][0] + doc_count, merged[k][1].merge(sketch))
+            else:
+                merged[k] = (doc_count, sketch)
+
+        return merged
+
+    def _metric_cells(self, key):
+        return [cells for (k, project), cells in self.cells.items() if k == key]
+
+    def _projects(self, key):
+        return [project for (k, project) in list(self.cells) if k == key]
+
+    def _count(self, key, search, sources, page_size):
+        # Buckets are sorted by month, so cells are finished as soon as
+        # the next month starts and only a month of values is kept
+        values = defaultdict(list)
+        counts = defaultdict(int)
+        current = None
+
+        def finish():
+            for (project, month, gender), cell_values in values.items():
+                self.cells[(key, project)][(month, gender)] = [counts[(project, month, gender)],
+                                                              DistinctSketch.from_values(cell_values)]
+            values.clear()
+            counts.clear()
+
+        for bucket in composite_buckets(search, sources, size=page_size):
+            k = bucket['key']
+            month = datetime.datetime.utcfromtimestamp(k['month'] / 1000).strftime("%Y-%m")
+
+            if month != current:
+                finish()
+                current = month
+
+            cell = (k.get('project', ALL_PROJECTS), month, k['gender'])
+            values[cell].append(k['value'])
+            counts[cell] += bucket['doc_count']
+
+        finish()
+
+
+def parse_args():
+    parser = ArgumentParser(usage="Usage: '%(prog)s [options] <command> <rollup>")
+
+    parser.add_argument('--since', dest='since', default='now/y-5y',
+                        help='First date counted when building the rollup')
+    parser.add_argument('--page-size', dest='page_size', type=int, default=1000,
+                        help='Number of buckets requested at once')
+
+    parser.add_argument('command', choices=['build', 'update'],
+                        help='Build the rollup from scratch or update its newest quarter')
+    parser.add_argument('rollup', help='File where the rollup is stored')
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    try:
+        if args.command == 'build':
+            rollup = GenderRollup()
+
+            for index, metric_field, filters in METRICS:
+                rollup.build(index, metric_field, filters, args.since, args.page_size)
+        else:
+            rollup = GenderRollup.load(args.rollup)
+            rollup.update(args.page_size)
+    finally:
+        close_connection()
+
+    rollup.save(args.rollup)
+
+    print ("%d metrics, %d cells stored in %s" % \
+           (len(rollup.metrics), sum(len(cells) for cells in rollup.cells.values()), args.rollup))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+''' Date windows of the rollup, compared with the rounding of Elasticsearch '''
+
+import datetime
+import unittest
+
+from elasticsearch_dsl import Q
+
+from rollup import ALL_PROJECTS, DistinctSketch, GenderRollup, next_month, resolve_month
+
+
+class TestResolveMonth(unittest.TestCase):
+
+    NOW = datetime.datetime(2017, 1, 15, 10, 30)
+
+    def test_months(self):
+        self.assertEqual(resolve_month('now/M', self.NOW), '2017-01')
+        self.assertEqual(resolve_month('now/M-1M', self.NOW), '2016-12')
+        self.assertEqual(resolve_month('now/M+1M', self.NOW), '2017-02')
+        self.assertEqual(resolve_month('now/M-4y', self.NOW), '2013-01')
+        self.assertEqual(resolve_month('now/M-13M', self.NOW), '2015-12')
+
+    def test_not_rounded_to_months(self):
+        self.assertIsNone(resolve_month('now', self.NOW))
+        self.assertIsNone(resolve_month('now-1d', self.NOW))
+        self.assertIsNone(resolve_month('now/y-1y', self.NOW))
+
+    def test_next_month(self):
+        self.assertEqual(next_month('2016-11'), '2016-12')
+        self.assertEqual(next_month('2016-12'), '2017-01')
+
+
+class TestAnswerWindows(unittest.TestCase):
+    ''' A month is in a window when Elasticsearch would match its documents
+
+    'gt' and 'lte' round up to the end of the month; 'gte' and 'lt'
+    round down to its start.
+    '''
+
+    def setUp(self):
+        self.rollup = GenderRollup()
+        self.key = self.rollup.metric_key("index", "id", [])
+        self.rollup.metrics[self.key] = {'index': "index", 'metric_field': "id", 'filters': []}
+
+        # A cell for every month from two years ago to the next one
+        month = resolve_month('now/M-2y')
+        self.months = []
+
+        while month <= resolve_month('now/M+1M'):
+            self.months.append(month)
+            self.rollup.cells[(self.key, ALL_PROJECTS)][(month, 'female')] = \
+                [1, DistinctSketch.from_values([month])]
+            month = next_month(month)
+
+    def answer(self, window):
+        filters = [Q('range', date=window)]
+        key, cells = self.rollup._answer("index", "id", filters)
+        return sorted(month for month, gender in cells)
+
+    def test_gt(self):
+        start = resolve_month('now/M-1y')
+        expected = [m for m in self.months if m > start]
+        self.assertEqual(self.answer({'gt': 'now/M-1y'}), expected)
+
+    def test_gte(self):
+        start = resolve_month('now/M-1y')
+        expected = [m for m in self.months if m >= start]
+        self.assertEqual(self.answer({'gte': 'now/M-1y'}), expected)
+
+    def test_lt(self):
+        end = resolve_month('now/M')
+        expected = [m for m in self.months if m < end]
+        self.assertEqual(self.answer({'lt': 'now/M'}), expected)
+
+    def test_lte(self):
+        end = resolve_month('now/M')
+        expected = [m for m in self.months if m <= end]
+        self.assertEqual(self.answer({'lte': 'now/M'}), expected)
+
+    def test_report_window(self):
+        # The windows of the report have eleven full months
+        self.assertEqual(len(self.answer({'gt': 'now/M-1y', 'lt': 'now/M'})), 11)
+
+    def test_not_in_rollup(self):
+        filters = [Q('range', date={'gt': 'now-1d'})]
+        self.assertIsNone(self.rollup._answer("index", "id", filters))
+
+
+if __name__ == '__main__':
+    unittest.main()
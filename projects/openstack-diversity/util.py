@@ -1,14 +1,58 @@
 
 import certifi
 import configparser
+import datetime
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
 
 from elasticsearch import Elasticsearch
 from elasticsearch_dsl import Search
 
-def ESConnection():
+# Client shared by every report, script and notebook of the process
+_es_conn = None
+_es_lock = threading.Lock()
+
+def ESConnection(settings='.settings'):
+    ''' Return the Elasticsearch client of the process
+
+    The client is created, and the settings read, the first time this
+    function is called. Later calls return the same client so its pool
+    of HTTP connections is kept warm.
+
+    Besides the connection data, the ElasticSearch section of the
+    settings file accepts these optional pool values:
+
+    :param maxsize: number of connections kept alive (default 10)
+    :param max_retries: retries of a failed request (default 3)
+    :param timeout: seconds to wait for a response (default 200)
+    '''
+
+    global _es_conn
+
+    with _es_lock:
+        if _es_conn is None:
+            _es_conn = _create_connection(settings)
+
+    return _es_conn
+
+def close_connection():
+    ''' Close the connections of the shared client, if any '''
+
+    global _es_conn
+
+    with _es_lock:
+        if _es_conn is not None:
+            _es_conn.transport.close()
+            _es_conn = None
+
+def _create_connection(settings):
 
     parser = configparser.ConfigParser()
-    parser.read('.settings')
+    parser.read(settings)
 
     section = parser['ElasticSearch']
     user = section['user']
@@ -17,12 +61,172 @@ def ESConnection():
     port = section['port']
     path = section['path']
 
+    maxsize = section.getint('maxsize', fallback=10)
+    max_retries = section.getint('max_retries', fallback=3)
+    timeout = section.getint('timeout', fallback=200)
+
     connection = "https://" + user + ":" + password + "@" + host + ":" + port + "/" + path
 
-    es_read = Elasticsearch([connection], use_ssl=True, verity_certs=True, ca_cert=certifi.where(), scroll='300m', timeout=200)
+    # Connections of the urllib3 pool are kept alive between requests;
+    # timeouts are retried as well since aggregations may be slow
+    es_read = Elasticsearch([connection], use_ssl=True, verify_certs=True, ca_certs=certifi.where(),
+                            maxsize=maxsize, max_retries=max_retries, retry_on_timeout=True,
+                            timeout=timeout)
 
     return es_read
 
+def composite_buckets(search, sources, size=1000, name='composite'):
+    ''' Iterate over the buckets of a composite aggregation
+
+    Buckets are requested in pages of `size`, each page starting after
+    the last key of the previous one, so neither the client nor the
+    cluster has to hold every bucket at once. Buckets are yielded as
+    dicts with their 'key' (a dict with a value per source) and
+    'doc_count', sorted by key.
+
+    :param search: Search with the index, client and filters to use
+    :param sources: list of composite sources, i.e.
+        [{'owner': {'terms': {'field': 'owner'}}}]
+    :param size: number of buckets per page
+    :param name: name given to the aggregation
+    '''
+
+    after = None
+
+    while True:
+        s = search.extra(size=0)
+        params = {'sources': sources, 'size': size}
+        if after is not None:
+            params['after'] = after
+        s.aggs.bucket(name, 'composite', **params)
+
+        aggregation = s.execute().to_dict()['aggregations'][name]
+        buckets = aggregation['buckets']
+
+        for bucket in buckets:
+            yield bucket
+
+        if len(buckets) < size:
+            break
+
+        after = aggregation.get('after_key', buckets[-1]['key'])
+
+class QueryCache:
+    ''' On-disk cache of the responses of Elasticsearch searches
+
+    Responses are stored as JSON files named after a hash of the index,
+    the body of the search (filters and aggregations) and the month
+    `now/M` resolves to, so cached results are not reused once the date
+    windows move. Entries older than `ttl` seconds are ignored and, when
+    the cache grows over `max_size` bytes, the least recently used ones
+    are removed. The cache may be shared by several threads.
+
+    :param path: directory where responses are stored
+    :param ttl: seconds a response is valid
+    :param max_size: maximum size of the cache in bytes
+    '''
+
+    def __init__(self, path, ttl=31*24*3600, max_size=100*1024*1024):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evicted': 0}
+        self._lock = threading.Lock()
+
+        os.makedirs(self.path, exist_ok=True)
+
+        # Size of the stored entries, updated when new ones are added
+        self.size = self.evict()
+
+    def key(self, index, body):
+        window = datetime.datetime.utcnow().strftime("%Y-%m")
+        data = json.dumps([index, body, window], sort_keys=True, default=str)
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def get(self, index, body):
+        file_path = os.path.join(self.path, self.key(index, body) + ".json")
+
+        try:
+            stat = os.stat(file_path)
+            age = time.time() - stat.st_mtime
+
+            if age > self.ttl:
+                os.remove(file_path)
+                with self._lock:
+                    self.size -= stat.st_size
+                    self.stats['expired'] += 1
+                    self.stats['misses'] += 1
+                return None
+
+            with open(file_path) as fd:
+                response = json.load(fd)
+        except (OSError, ValueError):
+            with self._lock:
+                self.stats['misses'] += 1
+            return None
+
+        # Access time is used to evict the least recently used entries
+        try:
+            os.utime(file_path, (time.time(), os.path.getmtime(file_path)))
+        except OSError:
+            pass
+
+        with self._lock:
+            self.stats['hits'] += 1
+        return response
+
+    def put(self, index, body, response):
+        file_path = os.path.join(self.path, self.key(index, body) + ".json")
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, 'w') as tmp:
+            json.dump(response, tmp)
+            entry_size = tmp.tell()
+        os.replace(tmp_path, file_path)
+
+        # The directory is only scanned when the limit is reached
+        with self._lock:
+            self.size += entry_size
+            if self.size <= self.max_size:
+                return
+            self.size = self.evict()
+
+    def evict(self):
+        ''' Remove the least recently used entries over the size limit
+
+        :returns: size of the remaining entries
+        '''
+
+        entries = []
+        size = 0
+
+        for entry in os.scandir(self.path):
+            if not entry.name.endswith(".json"):
+                continue
+            st = entry.stat()
+            entries.append((st.st_atime, st.st_size, entry.path))
+            size += st.st_size
+
+        for atime, entry_size, file_path in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(file_path)
+            except OSError:
+                continue
+            size -= entry_size
+            self.stats['evicted'] += 1
+
+        return size
+
+    def report(self):
+        total = self.stats['hits'] + self.stats['misses']
+        ratio = self.stats['hits'] / total * 100 if total else 0
+
+        return "cache: %(hits)d hits, %(misses)d misses" % self.stats + \
+            " (%.1f%% hit ratio), %d expired, %d evicted" % (ratio, self.stats['expired'],
+                                                              self.stats['evicted'])
+
 def test():
     es_conn = ESConnection()
 
@@ -33,5 +237,7 @@ def test():
         print(item)
         break
 
+    close_connection()
+
 if __name__ == "__main__":
     test()
@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014-2015 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+"""Code review latency metrics of the patch series of xen_patches.
+
+Script version of the 'Code-Review-Metrics' notebook. Patch series,
+versions, patches, comments, flags and commits are loaded once, from
+the database built by xen_patches or from its Parquet export, into
+data frames, and every metric is computed from them with vectorized
+operations instead of a query per metric.
+
+Time series span the dates found in the data, so no date range has to
+be given, and are grouped by month or quarter.
+"""
+
+import datetime
+import os
+
+from argparse import ArgumentParser
+
+import numpy as np
+import pandas
+
+from xen_patches import ConnectionManager, Instrumentation
+
+
+# Columns loaded of each table; members are loaded by email
+QUERIES = {
+    'patch_series' : """
+        SELECT id
+        FROM patch_series
+        """,
+    'patch_series_version' : """
+        SELECT id, ps_id, version, date
+        FROM patch_series_version
+        """,
+    'patches' : """
+        SELECT p.id, p.ps_version_id, pe.email as submitter, p.commit_id, p.date
+        FROM patches p
+        LEFT JOIN people pe ON pe.id = p.submitter_id
+        """,
+    'comments' : """
+        SELECT c.patch_id, pe.email as submitter, c.date
+        FROM comments c
+        LEFT JOIN people pe ON pe.id = c.submitter_id
+        """,
+    'flags' : """
+        SELECT patch_id, flag, value, date
+        FROM flags
+        """,
+    'commits' : """
+        SELECT id, committer_date
+        FROM commits
+        """,
+}
+
+PARQUET_COLUMNS = {
+    'patch_series' : ['id'],
+    'patch_series_version' : ['id', 'ps_id', 'version', 'date'],
+    'patches' : ['id', 'ps_version_id', 'submitter', 'commit_id', 'date'],
+    'comments' : ['patch_id', 'submitter', 'date'],
+    'flags' : ['patch_id', 'flag', 'value', 'date'],
+    'commits' : ['id', 'committer_date'],
+}
+
+DATE_COLUMNS = ['date', 'committer_date']
+
+# Flags given by the people reviewing a patch
+REVIEW_FLAGS = ['Reviewed-by', 'Acked-by']
+
+# Dates before this one are wrong, i.e. messages sent on 1970
+MIN_DATE = datetime.datetime(1990, 1, 1)
+
+FREQUENCIES = {'month' : 'M', 'quarter' : 'Q'}
+
+LATENCIES = ['time_to_first_review', 'time_to_ack', 'time_to_merge']
+
+
+class ReviewData(object):
+    """Tables of the patch series model as data frames.
+
+    Emails are lower cased and dates out of range are set to NaT,
+    so they are ignored by the metrics.
+    """
+
+    def __init__(self, tables):
+        for name, df in tables.items():
+            for column in df.columns:
+                if column in DATE_COLUMNS:
+                    dates = pandas.to_datetime(df[column])
+                    df[column] = dates.where(dates >= MIN_DATE)
+                elif column == 'submitter':
+                    df[column] = df[column].str.lower()
+
+        self.patch_series = tables['patch_series']
+        self.versions = tables['patch_series_version']
+        self.patches = tables['patches']
+        self.comments = tables['comments']
+        self.flags = tables['flags']
+        self.commits = tables['commits']
+
+    @classmethod
+    def from_database(cls, engine):
+        """Load the tables with a query each"""
+
+        return cls({name : pandas.read_sql(query, engine)
+                    for name, query in QUERIES.items()})
+
+    @classmethod
+    def from_parquet(cls, path):
+        """Load the tables from the datasets written by export_parquet"""
+
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("pyarrow is required to read Parquet datasets")
+
+        tables = {}
+
+        for name, columns in PARQUET_COLUMNS.items():
+            table = pyarrow.parquet.read_table(os.path.join(path, name),
+                                               columns=columns)
+            df = table.to_pandas()
+
+            # Dictionary encoded columns are read as categories
+            for column in df.columns:
+                if df[column].dtype.name == 'category':
+                    df[column] = df[column].astype(object)
+
+            tables[name] = df
+
+        return cls(tables)
+
+
+class ReviewMetrics(object):
+    """Code review metrics of the patch series.
+
+    `series` has a row per patch series with the dates of its review
+    and the latencies, in days, from the date it was first sent:
+
+    - time_to_first_review: first comment of someone else than the
+      submitter of the patch, or first review flag
+    - time_to_ack: first Acked-by flag
+    - time_to_merge: last commit of its patches
+
+    Flags carried in a patch as it was sent, i.e. an ack kept from a
+    previous version, are not reviews. Latencies are NaN when the
+    series never got there or when the date is not after the date it
+    was sent.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.reviews = self.__reviews()
+        self.series = self.__series()
+
+    def timeseries(self, freq='M'):
+        """Metrics of the series sent on each period.
+
+        The number of series, the mean of versions and patches, and
+        the mean and median of every latency are given for every
+        period from the first to the last series.
+        """
+        series = self.series.dropna(subset=['sent'])
+        periods = pandas.DatetimeIndex(series['sent']).to_period(freq)
+
+        aggs = {'versions' : ['size', 'mean'], 'patches' : ['mean']}
+        aggs.update((latency, ['mean', 'median']) for latency in LATENCIES)
+
+        df = series.groupby(periods.asi8).agg(aggs)
+        df.columns = ['_'.join(column) for column in df.columns]
+        df = df.rename(columns={'versions_size' : 'series'})
+
+        df = self.__by_period(df, periods, freq)
+        df['series'] = df['series'].fillna(0).astype(int)
+
+        columns = ['series', 'versions_mean', 'patches_mean']
+        columns += ['%s_%s' % (latency, f) for latency in LATENCIES
+                    for f in ('mean', 'median')]
+        return df[columns]
+
+    def reviewer_load(self, freq='M'):
+        """Number of series reviewed by each reviewer on each period.
+
+        Returns, by period, the number of reviewers and the mean,
+        median and maximum number of series they reviewed.
+        """
+        reviews = self.reviews.dropna(subset=['date', 'reviewer'])
+        periods = pandas.DatetimeIndex(reviews['date']).to_period(freq)
+
+        # Periods and reviewers are replaced by integers, which are
+        # hashed much faster than Period objects and emails
+        reviewed = pandas.DataFrame({'period' : periods.asi8,
+                                     'reviewer' : pandas.factorize(reviews['reviewer'])[0],
+                                     'ps_id' : reviews['ps_id'].values}).drop_duplicates()
+
+        load = reviewed.groupby(['period', 'reviewer']).size()
+        df = load.groupby(level='period').agg(['size', 'mean', 'median', 'max'])
+        df.columns = ['reviewers', 'mean', 'median', 'max']
+
+        df = self.__by_period(df, periods, freq)
+        df['reviewers'] = df['reviewers'].fillna(0).astype(int)
+        return df
+
+    def top_reviewers(self, n=10):
+        """Reviewers with the largest number of series reviewed"""
+
+        codes, reviewers = pandas.factorize(self.reviews['reviewer'])
+
+        reviewed = pandas.DataFrame({'reviewer' : codes,
+                                     'ps_id' : self.reviews['ps_id'].values}).drop_duplicates()
+        reviewed = reviewed[reviewed['reviewer'] >= 0]
+
+        load = pandas.Series(np.bincount(reviewed['reviewer'], minlength=len(reviewers)),
+                             index=pandas.Index(reviewers, name='reviewer'))
+        return load.sort_values(ascending=False).head(n).to_frame('series')
+
+    def __reviews(self):
+        """Comments and review flags, with the series they review"""
+
+        d = self.data
+
+        patches = d.patches[['id', 'ps_version_id', 'submitter', 'date']] \
+            .merge(d.versions[['id', 'ps_id']].rename(columns={'id' : 'ps_version_id'}),
+                   on='ps_version_id') \
+            .rename(columns={'id' : 'patch_id', 'submitter' : 'author',
+                             'date' : 'patch_date'})
+
+        comments = d.comments.merge(patches, on='patch_id')
+        comments = comments[comments['submitter'] != comments['author']]
+
+        # Flags of the patch itself have its date
+        flags = d.flags[d.flags['flag'].isin(REVIEW_FLAGS)].merge(patches, on='patch_id')
+        flags = flags[flags['date'] != flags['patch_date']]
+
+        # Flags are written as 'Name <email>'; the same values repeat
+        # a lot, so emails are extracted once per value
+        codes, values = pandas.factorize(flags['value'])
+        values = pandas.Series(values, dtype=object)
+        emails = values.str.extract('<([^>]+)>', expand=False) \
+            .fillna(values).str.strip().str.lower()
+        reviewers = pandas.Series(emails.values.take(codes))
+        reviewers[codes < 0] = None
+
+        return pandas.concat([
+            pandas.DataFrame({'ps_id' : comments['ps_id'].values,
+                              'reviewer' : comments['submitter'].values,
+                              'flag' : None,
+                              'date' : comments['date'].values}),
+            pandas.DataFrame({'ps_id' : flags['ps_id'].values,
+                              'reviewer' : reviewers.values,
+                              'flag' : flags['flag'].values,
+                              'date' : flags['date'].values})],
+            ignore_index=True)
+
+    def __series(self):
+        d = self.data
+
+        versions = d.versions.groupby('ps_id')
+        patches = d.patches.merge(d.versions[['id', 'ps_id']].rename(columns={'id' : 'ps_version_id'}),
+                                  on='ps_version_id')
+
+        merged = patches.dropna(subset=['commit_id']) \
+            .merge(d.commits.rename(columns={'id' : 'commit_id'}), on='commit_id') \
+            .groupby('ps_id')['committer_date'].max()
+
+        reviews = self.reviews.groupby('ps_id')['date']
+        acks = self.reviews[self.reviews['flag'] == 'Acked-by'].groupby('ps_id')['date']
+
+        df = pandas.DataFrame({'sent' : versions['date'].min(),
+                               'versions' : versions.size(),
+                               'patches' : patches.groupby('ps_id').size(),
+                               'first_review' : reviews.min(),
+                               'acked' : acks.min(),
+                               'merged' : merged},
+                              index=d.patch_series['id'].rename('ps_id'))
+        df['versions'] = df['versions'].fillna(0).astype(int)
+        df['patches'] = df['patches'].fillna(0).astype(int)
+
+        for latency, column in zip(LATENCIES, ['first_review', 'acked', 'merged']):
+            days = (df[column] - df['sent']) / np.timedelta64(1, 'D')
+            df[latency] = days.where(days > 0)
+
+        return df
+
+    @staticmethod
+    def __by_period(df, periods, freq):
+        """Index a frame grouped by period ordinals with every period
+        between the first and the last one"""
+
+        if periods.empty:
+            span = pandas.PeriodIndex([], freq=freq)
+        else:
+            span = pandas.period_range(periods.min(), periods.max(), freq=freq)
+
+        df = df.reindex(span.asi8)
+        df.index = span
+        return df
+
+
+def parse_args():
+    parser = ArgumentParser(usage="Usage: '%(prog)s [options] <database>")
+
+    # Database options
+    group = parser.add_argument_group('Database options')
+    group.add_argument('-u', '--user', dest='db_user',
+                       help='Database user name',
+                       default='root')
+    group.add_argument('-p', '--password', dest='db_password',
+                       help='Database user password',
+                       default='')
+    group.add_argument('--host', dest='db_hostname',
+                       help='Name of the host where the database server is running',
+                       default='localhost')
+    group.add_argument('--port', dest='db_port',
+                       help='Port of the host where the database server is running',
+                       default='3306')
+
+    # Input and output options
+    parser.add_argument('--parquet', dest='parquet', default=None,
+                        help='Read the Parquet datasets of this directory instead of the database')
+    parser.add_argument('--freq', dest='freq', choices=sorted(FREQUENCIES),
+                        default='month', help='Period of the time series')
+    parser.add_argument('-o', '--output-dir', dest='output_dir', default='.',
+                        help='Directory where the CSV files of the metrics are written')
+    parser.add_argument('--report', dest='report', default=None,
+                        help='File where the JSON report of the run will be written; stderr by default')
+
+    # Positional arguments
+    parser.add_argument('database', nargs='?', default=None,
+                        help='Database built by xen_patches')
+
+    args = parser.parse_args()
+
+    if not args.database and not args.parquet:
+        parser.error("a database or a Parquet directory is required")
+
+    return args
+
+
+def main():
+    args = parse_args()
+    stats = Instrumentation()
+    freq = FREQUENCIES[args.freq]
+
+    with stats.stage('load'):
+        if args.parquet:
+            data = ReviewData.from_parquet(args.parquet)
+        else:
+            manager = ConnectionManager(args.db_user, args.db_password,
+                                        args.db_hostname, args.db_port)
+            data = ReviewData.from_database(manager.engine(args.database))
+            manager.dispose()
+
+    with stats.stage('metrics'):
+        metrics = ReviewMetrics(data)
+        results = {'series' : metrics.series,
+                   'timeseries' : metrics.timeseries(freq),
+                   'reviewer_load' : metrics.reviewer_load(freq),
+                   'top_reviewers' : metrics.top_reviewers()}
+
+    for name, df in results.items():
+        df.to_csv(os.path.join(args.output_dir, name + '.csv'))
+
+    stats.incr('patch_series', len(metrics.series))
+    stats.incr('reviews', len(metrics.reviews))
+
+    stats.dump(args.report)
+
+
+if __name__ == '__main__':
+    main()
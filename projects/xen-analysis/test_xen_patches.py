@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014-2015 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+"""Incremental updates of xen_patches, compared with full runs,
+parsing on a pool of processes and the shape of the threads.
+
+The archives are generated by xen_patches_bench on SQLite, so the
+tests don't need MySQL.
+"""
+
+import datetime
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from sqlalchemy import create_engine
+
+import xen_patches
+from xen_patches_bench import SQLiteConnection, generate_archive
+
+
+class TestIncrementalUpdate(unittest.TestCase):
+
+    NSERIES = 60
+
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp()
+        self.archive_path = os.path.join(self.tmp_path, 'archive.db')
+
+        conn = SQLiteConnection(self.archive_path)
+        generate_archive(conn, random.Random(0), self.NSERIES)
+        conn.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+    def test_split_equals_full_run(self):
+        """Updating an archive split on a date stores the same rows"""
+
+        expected = self.__canonical(self.__run([self.archive_path], 'full'))
+
+        splits = [datetime.datetime(2012, 1, 5, 3),
+                  datetime.datetime(2012, 1, 10, 5)]
+        splits += [datetime.datetime(2012, 1, 1, 5) + datetime.timedelta(hours=13 * i)
+                   for i in range(12)]
+
+        for split in splits:
+            name = split.strftime('%Y%m%d%H')
+            archives = [self.__truncate(split, name), self.archive_path]
+            result = self.__canonical(self.__run(archives, name))
+
+            for table in expected:
+                self.assertEqual(result[table], expected[table],
+                                 "%s differ when split at %s" % (table, split))
+
+    def test_orphans_kept_until_their_parent_arrives(self):
+        """A response older than its parent is threaded the next update"""
+
+        split = datetime.datetime(2012, 1, 1, 18)
+        db_path = self.__run([self.__truncate(split, 'first')], 'orphans')
+
+        engine = create_engine('sqlite:///' + db_path)
+        orphans = list(engine.execute(xen_patches.Orphan.__table__.select()))
+        self.assertTrue(orphans)
+
+        marks = xen_patches.Database.from_url('sqlite:///' + db_path).high_water_marks()
+        self.assertLessEqual(marks['threads'], min(o.date for o in orphans))
+
+    def __truncate(self, split, name):
+        """Copy of the archive without the messages and commits sent
+        from `split` on"""
+
+        path = os.path.join(self.tmp_path, 'archive-%s.db' % name)
+        shutil.copy(self.archive_path, path)
+
+        conn = SQLiteConnection(path)
+        conn.executescript("""
+            DELETE FROM messages WHERE first_date >= '%(split)s';
+            DELETE FROM messages_people
+                WHERE message_id NOT IN (SELECT message_ID FROM messages);
+            DELETE FROM scmlog WHERE date >= '%(split)s';
+            """ % {'split' : split})
+        conn.commit()
+        conn.close()
+
+        return path
+
+    def __run(self, archives, name):
+        """Update a database with each archive in turn"""
+
+        db_path = os.path.join(self.tmp_path, 'patches-%s.db' % name)
+        db = xen_patches.Database.from_url('sqlite:///' + db_path)
+
+        for i, archive in enumerate(archives):
+            conn = SQLiteConnection(archive)
+            xen_patches.update(db, conn, conn, incremental=i > 0)
+            conn.close()
+
+        return db_path
+
+    @staticmethod
+    def __canonical(db_path):
+        """Rows of a database without their identifiers"""
+
+        engine = create_engine('sqlite:///' + db_path)
+
+        queries = {
+            'patch_series_version' : """
+                SELECT ps.message_id, psv.message_id, psv.version
+                FROM patch_series_version psv
+                    JOIN patch_series ps ON ps.id = psv.ps_id""",
+            'patches' : """
+                SELECT p.message_id, psv.message_id, c.rev
+                FROM patches p
+                    JOIN patch_series_version psv ON psv.id = p.ps_version_id
+                    LEFT JOIN commits c ON c.id = p.commit_id""",
+            'comments' : """
+                SELECT c.message_id, p.message_id, pe.email
+                FROM comments c
+                    JOIN patches p ON p.id = c.patch_id
+                    JOIN people pe ON pe.id = c.submitter_id""",
+            'flags' : """
+                SELECT p.message_id, f.flag, f.value, f.date
+                FROM flags f
+                    JOIN patches p ON p.id = f.patch_id""",
+            'commits' : """
+                SELECT rev, subject FROM commits""",
+        }
+
+        return {table : sorted(tuple(row) for row in engine.execute(query))
+                for table, query in queries.items()}
+
+
+class TestThreadForest(unittest.TestCase):
+
+    PAIRS = [('a', None), ('b', 'a'), ('c', 'b'), ('d', 'a'),
+             ('e', None), ('f', 'missing'), ('g', 'f')]
+
+    def test_sizes_and_depths(self):
+        builder = xen_patches.ThreadBuilder.from_pairs(self.PAIRS)
+        forest = xen_patches.ThreadForest.from_threads(builder.threads)
+
+        ids = [forest.messages[pos].msg_id for pos in forest.walk(forest.roots[0])]
+        self.assertEqual(ids, ['a', 'b', 'c', 'd'])
+        self.assertEqual(forest.subtree_sizes().tolist(), [4, 2, 1, 1, 1])
+        self.assertEqual(forest.depths().tolist(), [0, 1, 2, 1, 0])
+
+    def test_summary(self):
+        builder = xen_patches.ThreadBuilder()
+
+        for i, (msg_id, is_response_of) in enumerate(self.PAIRS):
+            msg = builder.message(msg_id)
+            msg.date = datetime.datetime(2012, 1, 1, i)
+            builder.link(msg, is_response_of)
+
+        self.assertEqual(builder.sizes(), [4, 1])
+        self.assertEqual(builder.summary(),
+                         {'threads' : 2, 'messages' : 5, 'orphans' : 1,
+                          'max_thread_size' : 4, 'max_thread_depth' : 2})
+
+        # Released threads are still counted
+        closed = list(builder.close_idle(datetime.datetime(2012, 1, 2),
+                                         datetime.timedelta(0)))
+        self.assertEqual(len(closed), 2)
+        self.assertEqual(builder.summary(),
+                         {'threads' : 2, 'messages' : 5, 'orphans' : 1,
+                          'max_thread_size' : 4, 'max_thread_depth' : 2})
+
+
+class TestParseInPool(unittest.TestCase):
+
+    DEPTH = 2000
+
+    def test_deep_thread(self):
+        """A chain of responses deeper than the recursion limit is
+        sent to the workers and back"""
+
+        date = datetime.datetime(2012, 1, 1)
+
+        root = self.__message('root', '[PATCH] deep thread', date)
+        msg = root
+
+        for i in range(self.DEPTH):
+            response = self.__message('m%d' % i, 'Re: [PATCH] deep thread',
+                                      date + datetime.timedelta(minutes=i + 1))
+            response.body = 'Acked-by: Reviewer %d <r%d@example.com>' % (i % 5, i % 5)
+            msg.responses.append(response)
+            msg = response
+
+        threads = [xen_patches.Thread(root)]
+        _, serial = xen_patches.PatchesParser().parse(threads, [])
+        _, pooled = xen_patches.PatchesParser().parse(threads, [], processes=2)
+
+        patch = pooled[0].versions[0].patches[0]
+        self.assertEqual(len(patch.comments), self.DEPTH)
+        self.assertEqual([(f.flag, f.value) for f in patch.flags],
+                         [(f.flag, f.value) for f in serial[0].versions[0].patches[0].flags])
+
+    @staticmethod
+    def __message(msg_id, subject, date):
+        msg = xen_patches.Message(msg_id)
+        msg.subject = subject
+        msg.body = 'Signed-off-by: Author <author@example.com>'
+        msg.sender = 'author@example.com'
+        msg.date = date
+        msg.date_tz = 0
+        return msg
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014-2015 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+"""Load the patch series of xen_patches into Elasticsearch.
+
+Script version of the 'Xen Code Review Kibana-dashboard builder v2'
+notebook. Patch series, patches, flags and comments are read from the
+database built by xen_patches with server-side cursors and sent to
+Elasticsearch in parallel bulk requests while they are read.
+
+Each document gets an id made of its type and the id of its row, so
+loading the same database again updates the documents instead of
+duplicating them.
+"""
+
+import collections
+import itertools
+import operator
+
+from argparse import ArgumentParser
+from multiprocessing.pool import ThreadPool
+
+import MySQLdb.cursors
+
+from elasticsearch import Elasticsearch, helpers
+
+from xen_patches import ConnectionManager, Instrumentation
+
+
+INDEX = 'xen-patchseries-reviewers'
+DOC_TYPE = 'patchserie'
+
+MAPPING = {
+    'mappings' : {
+        DOC_TYPE : {
+            'properties' : {
+                'sender' : {'type' : 'string', 'index' : 'not_analyzed'},
+                'sender_domain' : {'type' : 'string', 'index' : 'not_analyzed'}
+            }
+        }
+    }
+}
+
+# Every query selects the id of the document in its first column and
+# the fields of the dashboard, in the same order, in the rest. Dates
+# are read from the 'date' columns written by xen_patches.py, which
+# are in UTC as the 'date_utc' columns of the notebook were.
+
+# A series is sent by the first submitter of its patches, by email,
+# and it is merged when any of its patches was
+QUERY_PATCH_SERIES = """
+    SELECT CONCAT('patchserie-', ps.id) as _id,
+           ps.id as patchserie_id,
+           -1 as patch_id,
+           -1 as comment_id,
+           ps.subject as subject,
+           MIN(pe.email) as sender,
+           SUBSTRING_INDEX(MIN(pe.email), '@', -1) as sender_domain,
+           MIN(psv.date) as sent_date,
+           0 as balance,
+           'na' as flag,
+           MAX(IF(p.commit_id IS NULL, 0, 1)) as merged,
+           'patchserie' as emailtype,
+           0 as num_flag_review,
+           0 as num_flag_ack,
+           0 as num_patch,
+           0 as is_acked,
+           0 as post_ack_comment
+    FROM patch_series ps,
+         patch_series_version psv,
+         patches p,
+         people pe
+    WHERE pe.id = p.submitter_id AND
+          p.ps_version_id = psv.id AND
+          psv.ps_id = ps.id
+    GROUP BY ps.id, ps.subject
+    """
+
+# Flags are grouped by patch, so each patch is a single row however
+# many acks it got
+QUERY_PATCHES = """
+    SELECT CONCAT('patch-', p.id) as _id,
+           psv.ps_id as patchserie_id,
+           p.id as patch_id,
+           -1 as comment_id,
+           p.subject as subject,
+           pe.email as sender,
+           SUBSTRING_INDEX(pe.email, '@', -1) as sender_domain,
+           p.date as sent_date,
+           1 as balance,
+           'na' as flag,
+           IF(p.commit_id IS NULL, 0, 1) as merged,
+           'patch' as emailtype,
+           0 as num_flag_review,
+           0 as num_flag_ack,
+           1 as num_patch,
+           IF(t.patch_id IS NULL, 0, 1) as is_acked,
+           0 as post_ack_comment
+    FROM patch_series_version psv,
+         people pe,
+         patches p
+    LEFT JOIN (SELECT patch_id
+               FROM flags
+               WHERE flag = 'Acked-by'
+               GROUP BY patch_id) t
+    ON t.patch_id = p.id
+    WHERE p.submitter_id = pe.id AND
+          psv.id = p.ps_version_id
+    """
+
+QUERY_FLAGS = """
+    SELECT CONCAT('flag-', f.id) as _id,
+           psv.ps_id as patchserie_id,
+           f.patch_id as patch_id,
+           -1 as comment_id,
+           p.subject as subject,
+           SUBSTRING_INDEX(SUBSTRING_INDEX(f.value, '<', -1), '>', 1) as sender,
+           SUBSTRING_INDEX(SUBSTRING_INDEX(SUBSTRING_INDEX(f.value, '<', -1), '>', 1), '@', -1) as sender_domain,
+           f.date as sent_date,
+           IF(f.flag = 'Reviewed-by', -1, 0) as balance,
+           f.flag as flag,
+           0 as merged,
+           'flag' as emailtype,
+           IF(f.flag = 'Reviewed-by', 1, 0) as num_flag_review,
+           IF(f.flag = 'Acked-by', 1, 0) as num_flag_ack,
+           0 as num_patch,
+           0 as is_acked,
+           0 as post_ack_comment
+    FROM patch_series_version psv,
+         patches p,
+         flags f
+    WHERE psv.id = p.ps_version_id AND
+          p.id = f.patch_id
+    """
+
+# Comments sent after the first ack of their patch are flagged here
+# instead of patching the rows of the comments later
+QUERY_COMMENTS = """
+    SELECT CONCAT('comment-', c.id) as _id,
+           psv.ps_id as patchserie_id,
+           c.patch_id as patch_id,
+           c.id as comment_id,
+           c.subject as subject,
+           pe.email as sender,
+           SUBSTRING_INDEX(pe.email, '@', -1) as sender_domain,
+           c.date as sent_date,
+           0 as balance,
+           'na' as flag,
+           0 as merged,
+           'comment' as emailtype,
+           0 as num_flag_review,
+           0 as num_flag_ack,
+           0 as num_patch,
+           0 as is_acked,
+           IF(c.date > t.first_ack_date, 1, 0) as post_ack_comment
+    FROM patch_series_version psv,
+         patches p,
+         people pe,
+         comments c
+    LEFT JOIN (SELECT patch_id,
+                      MIN(date) as first_ack_date
+               FROM flags
+               WHERE flag = 'Acked-by'
+               GROUP BY patch_id) t
+    ON t.patch_id = c.patch_id
+    WHERE psv.id = p.ps_version_id AND
+          p.id = c.patch_id AND
+          c.submitter_id = pe.id
+    """
+
+QUERIES = [('patch_series', QUERY_PATCH_SERIES),
+           ('patches', QUERY_PATCHES),
+           ('flags', QUERY_FLAGS),
+           ('comments', QUERY_COMMENTS)]
+
+
+def iter_documents(conn, query, index=INDEX, doc_type=DOC_TYPE,
+                   fetch_size=1000):
+    """Iterate over the bulk actions of the rows of a query.
+
+    Rows are fetched from a server-side cursor, `fetch_size` at a time.
+    The offsets of the fields are taken once from the description of
+    the cursor; the first column is used as id of the documents.
+    """
+    cursor = conn.cursor(cursorclass=MySQLdb.cursors.SSCursor)
+
+    try:
+        cursor.execute(query)
+
+        names = [d[0] for d in cursor.description]
+        fields = names[1:]
+        values = operator.itemgetter(*range(1, len(names)))
+
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+
+            if not rows:
+                break
+
+            for row in rows:
+                yield {'_index' : index,
+                       '_type' : doc_type,
+                       '_id' : row[0],
+                       '_source' : dict(itertools.izip(fields, values(row)))}
+    finally:
+        cursor.close()
+
+
+def bulk(es, actions, chunk_size=500):
+    """Send a list of actions to Elasticsearch in bulk requests.
+
+    Returns the ids of the documents indexed; errors are raised as
+    `helpers.bulk` does.
+    """
+    indexed = set()
+
+    for ok, item in helpers.streaming_bulk(es, actions, chunk_size=chunk_size):
+        indexed.add(item['index']['_id'])
+
+    return indexed
+
+
+def load(conn, es, queries=QUERIES, index=INDEX, doc_type=DOC_TYPE,
+         thread_count=4, chunk_size=500, stats=None):
+    """Load the documents of the queries into an index.
+
+    Rows are read in the calling thread, so the connection is never
+    shared, and sent by `thread_count` threads in bulk requests of
+    `chunk_size` documents. At most two chunks per thread wait to be
+    sent. Returns the number of documents loaded by query name, i.e.
+    the number of distinct ids Elasticsearch acknowledged.
+    """
+    stats = stats or Instrumentation()
+    loaded = {}
+
+    es.indices.create(index=index, body=MAPPING, ignore=400)
+
+    pool = ThreadPool(thread_count)
+
+    try:
+        for name, query in queries:
+            with stats.stage(name):
+                actions = iter_documents(conn, query, index, doc_type, chunk_size)
+                pending = collections.deque()
+                indexed = set()
+
+                while True:
+                    chunk = list(itertools.islice(actions, chunk_size))
+
+                    if not chunk:
+                        break
+
+                    pending.append(pool.apply_async(bulk, (es, chunk, chunk_size)))
+
+                    if len(pending) > 2 * thread_count:
+                        indexed.update(pending.popleft().get())
+
+                while pending:
+                    indexed.update(pending.popleft().get())
+
+            loaded[name] = len(indexed)
+            stats.incr(name, len(indexed))
+    finally:
+        pool.close()
+        pool.join()
+
+    return loaded
+
+
+def parse_args():
+    parser = ArgumentParser(usage="Usage: '%(prog)s [options] <database>")
+
+    # Database options
+    group = parser.add_argument_group('Database options')
+    group.add_argument('-u', '--user', dest='db_user',
+                       help='Database user name',
+                       default='root')
+    group.add_argument('-p', '--password', dest='db_password',
+                       help='Database user password',
+                       default='')
+    group.add_argument('--host', dest='db_hostname',
+                       help='Name of the host where the database server is running',
+                       default='localhost')
+    group.add_argument('--port', dest='db_port',
+                       help='Port of the host where the database server is running',
+                       default='3306')
+
+    # Elasticsearch options
+    group = parser.add_argument_group('Elasticsearch options')
+    group.add_argument('--es', dest='es_url', default='localhost:9200',
+                       help='URL of the Elasticsearch server')
+    group.add_argument('--index', dest='index', default=INDEX,
+                       help='Index where documents are loaded')
+    group.add_argument('--threads', dest='threads', type=int, default=4,
+                       help='Number of threads sending bulk requests')
+    group.add_argument('--chunk-size', dest='chunk_size', type=int, default=500,
+                       help='Number of documents per bulk request')
+
+    # Positional arguments
+    parser.add_argument('database', help='Database built by xen_patches')
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    stats = Instrumentation()
+
+    manager = ConnectionManager(args.db_user, args.db_password,
+                                args.db_hostname, args.db_port)
+    es = Elasticsearch([args.es_url])
+
+    with manager.connection(args.database) as conn:
+        loaded = load(conn, es, index=args.index,
+                      thread_count=args.threads, chunk_size=args.chunk_size,
+                      stats=stats)
+
+    manager.dispose()
+
+    for name, secs in [(s['name'], s['seconds']) for s in stats.stages]:
+        print "%s: %s documents in %.2fs (%.2f docs/sec)" % \
+            (name, loaded[name], secs, loaded[name] / secs if secs else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -22,7 +22,20 @@
 #     Daniel Izquierdo <dizquierdo@bitergia.com>
 #
 
+import array
+import collections
+import contextlib
+import cProfile
+import datetime
+import json
+import multiprocessing
+import os
 import re
+import resource
+import shutil
+import sys
+import threading
+import time
 
 import MySQLdb
 import MySQLdb.cursors
@@ -30,15 +43,131 @@ import MySQLdb.cursors
 from argparse import ArgumentParser
 
 from sqlalchemy import Column, DateTime, Integer, String, Text, \
-    ForeignKey, create_engine
+    ForeignKey, bindparam, create_engine, func, select
 from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.orm.attributes import instance_state
+from sqlalchemy.orm.interfaces import MANYTOONE, ONETOMANY
 from sqlalchemy.engine.url import URL
 from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.pool import NullPool
 
 
 
+class Instrumentation(object):
+    """Timers, counters and memory samples of a run.
+
+    Stages are timed with `stage()`, or with `timed()` for lazy
+    iterables, and counters are increased with `incr()` or, when
+    they record a maximum, raised with `gauge()`. The peak
+    resident memory is sampled at the end of every stage. When
+    `profile` is set, stages also run under cProfile.
+
+    A stage run inside another one is reported with the name of its
+    parent, and its time is not added again to the total.
+    """
+
+    def __init__(self, profile=False):
+        self.started = datetime.datetime.utcnow()
+        self.stages = []
+        self.counters = {}
+        self.profiler = cProfile.Profile() if profile else None
+        self._running = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.time()
+        parent = self.__parent()
+
+        if self.profiler and parent is None:
+            self.profiler.enable()
+
+        self._running.append(name)
+
+        try:
+            yield
+        finally:
+            self._running.pop()
+
+            if self.profiler and parent is None:
+                self.profiler.disable()
+
+            self.__add_stage(name, time.time() - start, parent)
+
+    def timed(self, name, iterable):
+        """Generate the items of iterable, timing the time spent
+        producing them as a stage. Its parent is the stage running
+        when the first item is requested."""
+
+        # The body runs on the first request
+        parent = self.__parent()
+        it = iter(iterable)
+        elapsed = 0.0
+
+        while True:
+            start = time.time()
+
+            try:
+                item = next(it)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.time() - start
+
+            yield item
+
+        self.__add_stage(name, elapsed, parent)
+
+    def incr(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        self.counters[name] = max(self.counters.get(name, value), value)
+
+    def merge(self, counters):
+        for name, value in counters.items():
+            self.incr(name, value)
+
+    @staticmethod
+    def peak_rss():
+        """Returns the peak resident memory of the process, in kilobytes"""
+
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        # Linux reports kilobytes but OS X reports bytes
+        return rss / 1024 if sys.platform == 'darwin' else rss
+
+    def report(self):
+        return {'started' : self.started.isoformat(),
+                'seconds' : sum(s['seconds'] for s in self.stages
+                                if s['parent'] is None),
+                'peak_rss_kb' : self.peak_rss(),
+                'stages' : self.stages,
+                'counters' : self.counters}
+
+    def dump(self, path=None, profile_path=None):
+        """Write the report as JSON, to stderr when path is not given"""
+
+        report = json.dumps(self.report(), indent=2, sort_keys=True)
+
+        if path:
+            with open(path, 'w') as f:
+                f.write(report + '\n')
+        else:
+            print >> sys.stderr, report
+
+        if self.profiler and profile_path:
+            self.profiler.dump_stats(profile_path)
+
+    def __parent(self):
+        return self._running[-1] if self._running else None
+
+    def __add_stage(self, name, seconds, parent=None):
+        self.stages.append({'name' : name,
+                            'parent' : parent,
+                            'seconds' : seconds,
+                            'peak_rss_kb' : self.peak_rss()})
+
+
 class Thread(object):
 
     def __init__(self, root):
@@ -47,16 +176,159 @@ class Thread(object):
     def __str__(self):
         return self.__pretty_print(self.root)
 
-    def __pretty_print(self, msg, indent=0):
-        s = ' ' * indent + str(msg) + '\n'
+    def __getstate__(self):
+        # Messages are flattened in depth-first order with the position
+        # of their parent, so deep threads don't exhaust the stack
+        messages = []
+        to_visit = [(self.root, -1)]
 
-        for r in msg.responses:
-            s += self.__pretty_print(r, indent + 2)
-        return s
+        while to_visit:
+            msg, parent = to_visit.pop()
+            messages.append((parent, msg.fields()))
+
+            pos = len(messages) - 1
+            to_visit.extend((r, pos) for r in reversed(msg.responses))
+
+        return messages
+
+    def __setstate__(self, messages):
+        built = []
+
+        for parent, fields in messages:
+            msg = Message.from_fields(fields)
+
+            if parent >= 0:
+                built[parent].responses.append(msg)
+            built.append(msg)
+
+        self.root = built[0]
+
+    def __pretty_print(self, root):
+        lines = []
+        to_print = [(root, 0)]
+
+        while to_print:
+            msg, indent = to_print.pop()
+            lines.append(' ' * indent + str(msg) + '\n')
+            to_print.extend((r, indent + 2) for r in reversed(msg.responses))
+
+        return ''.join(lines)
+
+
+class ThreadForest(object):
+    """Compact representation of a set of threads.
+
+    The messages are stored in a list, while the structure of the
+    threads is kept in arrays of integers with the positions of the
+    parent, the first child and the next sibling of each message (-1
+    when there is none).
+
+    A message is always added after its parent, so traversals, sizes
+    and depths are computed in linear time without recursion.
+    """
+
+    def __init__(self):
+        self.messages = []
+        self.roots = array.array('l')
+        self.parent = array.array('l')
+        self.first_child = array.array('l')
+        self.next_sibling = array.array('l')
+        self._last_child = array.array('l')
+
+    def __len__(self):
+        return len(self.messages)
+
+    @classmethod
+    def from_threads(cls, threads):
+        forest = cls()
+
+        for th in threads:
+            to_add = [(th.root, -1)]
+
+            while to_add:
+                msg, parent = to_add.pop()
+                pos = forest.add(msg, parent)
+                to_add.extend((r, pos) for r in reversed(msg.responses))
+
+        return forest
+
+    def add(self, msg, parent=-1):
+        """Add a message as the last child of parent or as a root.
+
+        Returns the position of the message on the forest.
+        """
+        pos = len(self.messages)
+
+        self.messages.append(msg)
+        self.parent.append(parent)
+        self.first_child.append(-1)
+        self.next_sibling.append(-1)
+        self._last_child.append(-1)
+
+        if parent < 0:
+            self.roots.append(pos)
+        elif self.first_child[parent] < 0:
+            self.first_child[parent] = pos
+        else:
+            self.next_sibling[self._last_child[parent]] = pos
+
+        if parent >= 0:
+            self._last_child[parent] = pos
+
+        return pos
+
+    def children(self, pos):
+        child = self.first_child[pos]
+
+        while child >= 0:
+            yield child
+            child = self.next_sibling[child]
+
+    def walk(self, pos):
+        """Generate the positions of a subtree in depth-first order"""
+
+        to_visit = [pos]
+
+        while to_visit:
+            pos = to_visit.pop()
+            yield pos
+
+            children = list(self.children(pos))
+            children.reverse()
+            to_visit.extend(children)
+
+    def subtree_sizes(self):
+        """Returns the size of the subtree of each message"""
+
+        sizes = array.array('l', [1]) * len(self.messages)
+
+        for pos in xrange(len(self.messages) - 1, -1, -1):
+            parent = self.parent[pos]
+
+            if parent >= 0:
+                sizes[parent] += sizes[pos]
+
+        return sizes
+
+    def depths(self):
+        """Returns the depth of each message; roots are at depth 0"""
+
+        depths = array.array('l', [0]) * len(self.messages)
+
+        for pos in xrange(len(self.messages)):
+            parent = self.parent[pos]
+
+            if parent >= 0:
+                depths[pos] = depths[parent] + 1
+
+        return depths
 
 
 class Message(object):
 
+    __slots__ = ('msg_id', 'subject', 'body', 'date', 'date_tz',
+                 'sender', 'mailing_list', 'responses')
+
     def __init__(self, msg_id):
         self.msg_id = msg_id
         self.subject = None
@@ -71,6 +343,250 @@ class Message(object):
         return '<Email %(subject)s - (%(date)s)>' % {'date': str(self.date),
                                                      'subject' : self.subject}
 
+    def __getstate__(self):
+        return tuple(getattr(self, attr) for attr in self.__slots__)
+
+    def __setstate__(self, state):
+        for attr, value in zip(self.__slots__, state):
+            setattr(self, attr, value)
+
+    def fields(self):
+        """Returns the values of the message, but its responses"""
+
+        return tuple(getattr(self, attr) for attr in self.__slots__[:-1])
+
+    @classmethod
+    def from_fields(cls, fields):
+        msg = cls.__new__(cls)
+        msg.__setstate__(fields + ([],))
+        return msg
+
+
+class ThreadBuilder(object):
+    """Builds threads of messages from their In-Reply-To.
+
+    Messages are found by id in a dict, so each one is linked to its
+    parent whatever the order they arrive in. A placeholder stands for
+    a parent not seen yet and keeps its responses until the parent
+    arrives. Messages without parent start a new thread. Responses to
+    messages that never arrive are left out of the threads; the
+    placeholders of those messages are the orphans.
+
+    Links that would close a loop are ignored. Checking them walks up
+    the ancestors of the parent, so linking a message costs O(depth)
+    and building the threads O(messages * depth), which is close to
+    linear on mailing lists, where threads are shallow.
+
+    Released threads and orphans are forgotten, but they are still
+    counted in the summary.
+    """
+
+    def __init__(self):
+        # Threads not released yet, sorted by creation
+        self.threads = []
+        # Date of the last message added to each thread
+        self.activity = {}
+        # Messages, their parents and the threads they belong to, by id
+        self.messages = {}
+        self.parents = {}
+        self.owners = {}
+        # Ids of the messages read, as opposed to placeholders
+        self.seen = set()
+        # Date of the last response waiting for each orphan
+        self._waiting = {}
+        self._strings = {}
+        # Totals of the threads and orphans released
+        self._released = {'threads' : 0, 'messages' : 0, 'orphans' : 0,
+                          'max_thread_size' : 0, 'max_thread_depth' : 0}
+
+    def __len__(self):
+        return len(self.threads)
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        """Build the threads of (message id, is_response_of) pairs,
+        i.e. the columns of the messages table of mlstats"""
+
+        builder = cls()
+
+        for msg_id, is_response_of in pairs:
+            builder.link(builder.message(msg_id), is_response_of)
+
+        return builder
+
+    def message(self, msg_id):
+        """Returns the message with the given id, creating a
+        placeholder when it was not seen yet"""
+
+        msg = self.messages.get(msg_id)
+
+        if msg is None:
+            msg = Message(msg_id)
+            self.messages[msg_id] = msg
+
+        return msg
+
+    def intern(self, s):
+        if s is None:
+            return s
+        return self._strings.setdefault(s, s)
+
+    def link(self, msg, is_response_of=None):
+        """Add a message to the threads.
+
+        Returns the thread of the message, or None when its parent
+        is not known yet.
+        """
+        self.seen.add(msg.msg_id)
+        self._waiting.pop(msg.msg_id, None)
+
+        if is_response_of is None or self.__is_ancestor(msg.msg_id, is_response_of):
+            thread = Thread(msg)
+            self.threads.append(thread)
+            self.__attach(msg, thread)
+        else:
+            thread = self.__set_parent(msg, is_response_of)
+
+        if thread:
+            self.activity[thread] = msg.date
+        else:
+            self._waiting[self.__top(msg.msg_id)] = msg.date
+
+        return thread
+
+    def close_idle(self, date, timeout):
+        """Generate and release the threads without new messages
+        for longer than timeout at date"""
+
+        still_open = []
+
+        for thread in self.threads:
+            if date - self.activity[thread] > timeout:
+                self.release(thread)
+                yield thread
+            else:
+                still_open.append(thread)
+
+        self.threads = still_open
+
+    def close_orphans(self, date, timeout):
+        """Release and return the orphans whose responses have been
+        waiting for their parent for longer than timeout at date"""
+
+        expired = []
+
+        for msg_id, last_date in self._waiting.items():
+            # Orphans attached to a parent after they were added
+            if msg_id in self.parents or msg_id in self.owners:
+                del self._waiting[msg_id]
+            elif date - last_date > timeout:
+                orphan = self.messages[msg_id]
+                self.__forget(orphan)
+                self._released['orphans'] += 1
+                expired.append(orphan)
+
+        return expired
+
+    def release(self, thread):
+        """Forget the messages of a thread"""
+
+        depth = max(ThreadForest.from_threads([thread]).depths())
+        size = self.__forget(thread.root)
+
+        released = self._released
+        released['threads'] += 1
+        released['messages'] += size
+        released['max_thread_size'] = max(released['max_thread_size'], size)
+        released['max_thread_depth'] = max(released['max_thread_depth'], depth)
+
+        self.activity.pop(thread, None)
+
+    def orphans(self):
+        """Returns the placeholders of the messages that received
+        responses but were never found"""
+
+        return [m for m in self.messages.values()
+                if m.msg_id not in self.seen and m.msg_id not in self.owners]
+
+    def roots(self):
+        return [thread.root for thread in self.threads]
+
+    def sizes(self):
+        """Returns the number of messages of each thread"""
+
+        forest = ThreadForest.from_threads(self.threads)
+        sizes = forest.subtree_sizes()
+
+        return [sizes[root] for root in forest.roots]
+
+    def summary(self):
+        forest = ThreadForest.from_threads(self.threads)
+        sizes = forest.subtree_sizes()
+        released = self._released
+
+        return {'threads' : len(forest.roots) + released['threads'],
+                'messages' : len(forest) + released['messages'],
+                'orphans' : len(self.orphans()) + released['orphans'],
+                'max_thread_size' : max([sizes[root] for root in forest.roots] +
+                                        [released['max_thread_size']]),
+                'max_thread_depth' : max(forest.depths().tolist() +
+                                         [released['max_thread_depth']])}
+
+    def __forget(self, root):
+        """Forget the messages of a subtree; returns their number"""
+
+        size = 0
+        to_forget = [root]
+
+        while to_forget:
+            m = to_forget.pop()
+            self.messages.pop(m.msg_id, None)
+            self.parents.pop(m.msg_id, None)
+            self.owners.pop(m.msg_id, None)
+            self.seen.discard(m.msg_id)
+            self._waiting.pop(m.msg_id, None)
+            to_forget.extend(m.responses)
+            size += 1
+
+        return size
+
+    def __top(self, msg_id):
+        while msg_id in self.parents:
+            msg_id = self.parents[msg_id]
+        return msg_id
+
+    def __is_ancestor(self, msg_id, of):
+        ancestor = of
+
+        while ancestor is not None:
+            if ancestor == msg_id:
+                return True
+            ancestor = self.parents.get(ancestor)
+
+        return False
+
+    def __set_parent(self, msg, parent_id):
+        parent = self.message(parent_id)
+        parent.responses.append(msg)
+        self.parents[msg.msg_id] = parent_id
+
+        thread = self.owners.get(parent_id, None)
+
+        if thread:
+            self.__attach(msg, thread)
+
+        return thread
+
+    def __attach(self, msg, thread):
+        # Placeholders may have received responses before
+        # being attached to a thread
+        to_attach = [msg]
+
+        while to_attach:
+            m = to_attach.pop()
+            self.owners[m.msg_id] = thread
+            to_attach.extend(m.responses)
+
 
 class SCMLog(object):
 
@@ -90,9 +606,44 @@ class SCMLog(object):
                                                  'date' : self.commit_date}
 
 
-def retrieve_patch_threads(conn, from_date, to_date):
+def retrieve_patch_threads(conn, from_date, to_date, batch_size=1000,
+                           orphans=None):
     """Returns a list of threads."""
 
+    return [th for th in iter_patch_threads(conn, from_date, to_date,
+                                            batch_size=batch_size,
+                                            orphans=orphans)]
+
+
+def iter_patch_threads(conn, from_date, to_date, batch_size=1000,
+                       timeout=None, orphans=None, builder=None, skip=None):
+    """Generates the threads of patches sent between two dates.
+
+    Messages are read through a server-side cursor in chunks of
+    `batch_size` rows, so the result set is never fully loaded in
+    memory. Threads are built incrementally while the rows arrive.
+
+    By default, threads are generated once every message has been
+    read. When `timeout` (a `datetime.timedelta`) is given, a thread
+    is considered finished when no message was added to it during
+    that period of time. Finished threads are generated as soon as
+    they are detected and their messages are released, keeping in
+    memory only the threads that are still open. Responses sent
+    after a thread was closed are discarded, the same way responses
+    to unknown messages are. Unknown messages whose responses waited
+    for them longer than `timeout` are released as orphans.
+
+    When `orphans` is a list, the unknown messages that received
+    responses are added to it as they are released or once every
+    message has been read. Each one only has its id and its list of
+    responses set.
+
+    Threads are built by `builder`, a ThreadBuilder, which can be
+    given to get the summary of the threads once they are generated.
+
+    Messages whose ids are in `skip`, such as the ones already read
+    on `from_date` by a previous run, are left out.
+    """
     def clean_subject(s):
         s = s.replace('\n', ' ')
         s = s.replace('\t', '')
@@ -113,90 +664,124 @@ def retrieve_patch_threads(conn, from_date, to_date):
             ORDER BY first_date
             """
 
-    cursor = conn.cursor(cursorclass=MySQLdb.cursors.DictCursor)
+    cursor = conn.cursor(cursorclass=MySQLdb.cursors.SSDictCursor)
     cursor.execute(query, [from_date, to_date])
-    raw_messages =  cursor.fetchall()
 
-    threads = []
-    messages = {}
+    if builder is None:
+        builder = ThreadBuilder()
 
-    for raw_msg in raw_messages:
-        msg_id = raw_msg['msg_id']
-        is_response_of = raw_msg['is_response_of']
+    try:
+        while True:
+            raw_messages = cursor.fetchmany(batch_size)
 
-        if msg_id not in messages:
-            m = Message(msg_id)
-            messages[msg_id] = m
-        else:
-            m = messages[msg_id]
-
-        m.msg_id = raw_msg["msg_id"]
-        m.subject = clean_subject(raw_msg['subject'])
-        m.body = raw_msg['body']
-        m.date = raw_msg['date']
-        m.date_tz = raw_msg['date_tz']
-        m.sender = raw_msg['sender']
-        m.mailing_list = raw_msg['url']
-
-        # New thread
-        if is_response_of is None:
-            thread = Thread(m)
-            threads.append(thread)
-        else:
-            if is_response_of not in messages:
-                p = Message(is_response_of)
-                messages[is_response_of] = p
-            else:
-                p = messages[is_response_of]
+            if not raw_messages:
+                break
+
+            for raw_msg in raw_messages:
+                if skip and raw_msg['msg_id'] in skip:
+                    continue
+
+                m = builder.message(raw_msg['msg_id'])
+
+                m.subject = clean_subject(raw_msg['subject'])
+                m.body = raw_msg['body']
+                m.date = raw_msg['date']
+                m.date_tz = raw_msg['date_tz']
+                m.sender = builder.intern(raw_msg['sender'])
+                m.mailing_list = raw_msg['url']
+
+                builder.link(m, raw_msg['is_response_of'])
 
-            p.responses.append(m)
+            if timeout is None:
+                continue
+
+            # Generate the threads that were closed
+            last_date = raw_messages[-1]['date']
+
+            for thread in builder.close_idle(last_date, timeout):
+                yield thread
+
+            expired = builder.close_orphans(last_date, timeout)
+
+            if orphans is not None:
+                orphans.extend(expired)
+    finally:
+        cursor.close()
+
+    if orphans is not None:
+        orphans.extend(builder.orphans())
+
+    for thread in builder.threads:
+        yield thread
 
-    return threads
 
+def retrieve_commits(conn, from_date, to_date, chunk_size=5000):
+    """Returns a list of commits"""
 
-def retrieve_commits(conn, from_date, to_date):
-    """Returns a dict of commits by subject"""
+    return [log for log in iter_commits(conn, from_date, to_date,
+                                        chunk_size=chunk_size)]
 
+
+def iter_commits(conn, from_date, to_date, chunk_size=5000, skip=None):
+    """Generates the commits done between two dates.
+
+    Commits are read in chunks of `chunk_size` rows sorted by date
+    and id. Each chunk starts after the last commit of the previous
+    one (keyset pagination), so every query is a range scan whatever
+    the number of commits already read. Emails of authors and
+    committers are resolved by the same query.
+
+    Commits whose revisions are in `skip` are left out.
+    """
     query = """
-            SELECT id AS id, rev AS rev, date AS commit_date, author_date AS author_date,
-                date_tz as commit_date_tz, author_date_tz as author_date_tz,
-                message AS message, author_id AS author_id, committer_id AS committer_id
+            SELECT s.id AS id, s.rev AS rev, s.date AS commit_date, s.author_date AS author_date,
+                s.date_tz as commit_date_tz, s.author_date_tz as author_date_tz,
+                s.message AS message, pa.email AS author, pc.email AS committer
             FROM scmlog s
-            WHERE date >= %s and date < %s
-                AND s.id IN (SELECT DISTINCT(commit_id) FROM actions)
-            ORDER BY date
+                LEFT JOIN people pa ON pa.id = s.author_id
+                LEFT JOIN people pc ON pc.id = s.committer_id
+            WHERE s.date < %s
+                AND (s.date > %s OR (s.date = %s AND s.id > %s))
+                AND EXISTS (SELECT 1 FROM actions a WHERE a.commit_id = s.id)
+            ORDER BY s.date, s.id
+            LIMIT %s
             """
 
-    query_people = """
-                   SELECT id, email
-                   FROM people
-                   """
-
     cursor = conn.cursor(cursorclass=MySQLdb.cursors.DictCursor)
-    cursor.execute(query_people)
-    raw_people =  cursor.fetchall()
 
-    people = {rp['id'] : rp['email'] for rp in raw_people}
+    # Start before the first commit done on `from_date`
+    last_date = from_date
+    last_id = -1
 
-    cursor.execute(query, [from_date, to_date])
-    raw_scmlog = cursor.fetchall()
+    try:
+        while True:
+            cursor.execute(query, [to_date, last_date, last_date, last_id,
+                                   chunk_size])
+            raw_scmlog = cursor.fetchall()
 
-    scm_logs = []
+            for rs in raw_scmlog:
+                if skip and rs['rev'] in skip:
+                    continue
+
+                log = SCMLog(rs['id'])
+                log.rev = rs['rev']
+                log.author = rs['author']
+                log.committer = rs['committer']
+                log.author_date = rs['author_date']
+                log.author_date_tz = rs['author_date_tz']
+                log.commit_date = rs['commit_date']
+                log.commit_date_tz = rs['commit_date_tz']
+                log.message = rs['message']
 
-    for rs in raw_scmlog:
-        log = SCMLog(rs['id'])
-        log.rev = rs['rev']
-        log.author = people[rs['author_id']]
-        log.committer = people[rs['committer_id']]
-        log.author_date = rs['author_date']
-        log.author_date_tz = rs['author_date_tz']
-        log.commit_date = rs['commit_date']
-        log.commit_date_tz = rs['commit_date_tz']
-        log.message = rs['message']
+                yield log
 
-        scm_logs.append(log)
+            if len(raw_scmlog) < chunk_size:
+                break
 
-    return scm_logs
+            last_date = raw_scmlog[-1]['commit_date']
+            last_id = raw_scmlog[-1]['id']
+    finally:
+        cursor.close()
 
 
 # Database model
@@ -222,6 +807,7 @@ class PatchSeriesVersion(Base):
     __table_args__ = ({'mysql_charset': 'utf8'})
 
     id = Column(Integer, primary_key=True)
+    message_id = Column(String(256))
     version = Column(Integer)
     subject = Column(String(256))
     body = Column(Text)
@@ -334,15 +920,116 @@ class Member(Base):
     email = Column(String(256))
 
 
+class Orphan(Base):
+    """Message not found yet that received responses, which are
+    read again by the next incremental update"""
+
+    __tablename__ = 'orphans'
+    __table_args__ = ({'mysql_charset': 'utf8'})
+
+    id = Column(Integer, primary_key=True)
+    message_id = Column(String(256))
+    date = Column(DateTime)
+
+
 # Database management
 
+class ConnectionManager(object):
+    """Pools of connections to the databases of a MySQL server.
+
+    An engine, with its own pool of connections, is created the first
+    time a database is used. Connections are returned to the pool
+    when they are released, so they are reused by the next retrieval,
+    by `Database` or by the queries run from the notebooks.
+    """
+
+    def __init__(self, user, password, host='localhost', port='3306',
+                 pool_size=5, max_overflow=10, pool_recycle=3600):
+        self.user = user
+        self.password = password
+        self.host = host
+        self.port = port
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.pool_recycle = pool_recycle
+        self._engines = {}
+        self._lock = threading.Lock()
+
+    def url(self, database):
+        return URL('mysql', self.user, self.password, self.host, self.port,
+                   database, query={'charset' : 'utf8'})
+
+    def engine(self, database):
+        with self._lock:
+            if database not in self._engines:
+                engine = create_engine(self.url(database),
+                                       pool_size=self.pool_size,
+                                       max_overflow=self.max_overflow,
+                                       pool_recycle=self.pool_recycle,
+                                       echo=False)
+                self._engines[database] = engine
+            return self._engines[database]
+
+    @contextlib.contextmanager
+    def connection(self, database):
+        """Borrow a DB-API connection from the pool of a database"""
+
+        conn = self.engine(database).raw_connection()
+
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @contextlib.contextmanager
+    def cursor(self, database, cursorclass=MySQLdb.cursors.DictCursor):
+        with self.connection(database) as conn:
+            cursor = conn.cursor(cursorclass=cursorclass)
+
+            try:
+                yield cursor
+            finally:
+                cursor.close()
+
+    def execute(self, database, query, args=None):
+        """Run a query and return its rows as dicts"""
+
+        with self.cursor(database) as cursor:
+            cursor.execute(query, args)
+            return cursor.fetchall()
+
+    def dispose(self):
+        """Close every connection of the pools"""
+
+        with self._lock:
+            for engine in self._engines.values():
+                engine.dispose()
+            self._engines = {}
+
+
 class Database(object):
 
-    def __init__(self, user, password, database, host='localhost', port='3306'):
-        # Create an engine
-        self.url = URL('mysql', user, password, host, port, database,
-                       query={'charset' : 'utf8'})
-        self._engine = create_engine(self.url, poolclass=NullPool, echo=False)
+    # Tables of the messages parsed, by message id
+    MESSAGE_TABLES = [PatchSeriesVersion.__table__, Patch.__table__,
+                      Comment.__table__]
+
+    def __init__(self, user, password, database, host='localhost', port='3306',
+                 manager=None):
+        if manager is None:
+            manager = ConnectionManager(user, password, host, port)
+        self.__setup(manager.engine(database))
+
+    @classmethod
+    def from_url(cls, url):
+        """Create a database from a SQLAlchemy URL (i.e 'sqlite://')"""
+
+        db = cls.__new__(cls)
+        db.__setup(create_engine(url, echo=False))
+        return db
+
+    def __setup(self, engine):
+        self.url = engine.url
+        self._engine = engine
         self._Session = sessionmaker(bind=self._engine)
 
         # Create the schema on the database.
@@ -363,6 +1050,131 @@ class Database(object):
             session.rollback()
             raise
 
+    def store_many(self, objs, batch_size=1000):
+        """Store a set of objects and the objects related to them.
+
+        Instead of adding the objects to a session, rows are written
+        table by table with executemany statements of `batch_size`
+        rows. Identifiers are assigned before inserting, so foreign
+        keys are resolved in memory. Objects that already have an
+        identifier are considered stored; only their references to
+        new objects are updated.
+
+        Identifiers are allocated and rows written in a single
+        transaction, with the tables locked on MySQL so concurrent
+        writers can't take the same identifiers. When it fails, the
+        transaction is rolled back and the identifiers and references
+        set in memory are undone.
+
+        Returns the number of rows written and the seconds spent.
+        """
+        start = time.time()
+
+        # Find every object reachable from the given ones
+        nodes = []
+        seen = set()
+        to_visit = list(objs)
+        to_visit.reverse()
+
+        while to_visit:
+            obj = to_visit.pop()
+
+            if id(obj) in seen:
+                continue
+            seen.add(id(obj))
+            nodes.append(obj)
+
+            state = instance_state(obj)
+
+            for rel in state.mapper.relationships:
+                value = state.dict.get(rel.key, None)
+
+                if value is None:
+                    continue
+                elif rel.uselist:
+                    to_visit.extend(reversed(value))
+                else:
+                    to_visit.append(value)
+
+        new = {}
+
+        for obj in nodes:
+            if obj.id is None:
+                table = instance_state(obj).mapper.local_table
+                new.setdefault(table, []).append(obj)
+
+        inserted = set(id(obj) for table_objs in new.values() for obj in table_objs)
+        updates = {}
+        restore = []
+
+        try:
+            with self._engine.connect() as conn:
+                self.__lock_tables(conn)
+
+                try:
+                    with conn.begin():
+                        nrows = self.__write(conn, nodes, new, inserted,
+                                             updates, restore, batch_size)
+                finally:
+                    self.__unlock_tables(conn)
+        except Exception:
+            for table_objs in new.values():
+                for obj in table_objs:
+                    obj.id = None
+
+            for obj, key, value in reversed(restore):
+                setattr(obj, key, value)
+            raise
+
+        return nrows, time.time() - start
+
+    def __write(self, conn, nodes, new, inserted, updates, restore, batch_size):
+        """Allocate the identifiers of the new objects and write them"""
+
+        for table, table_objs in new.items():
+            last_id = conn.execute(select([func.max(table.c.id)])).scalar()
+            last_id = last_id or 0
+
+            for obj in table_objs:
+                last_id += 1
+                obj.id = last_id
+
+        # Resolve foreign keys
+
+        for obj in nodes:
+            state = instance_state(obj)
+
+            for rel in state.mapper.relationships:
+                value = state.dict.get(rel.key, None)
+
+                if value is None:
+                    continue
+                elif rel.direction is MANYTOONE:
+                    self.__link(obj, value, rel.local_remote_pairs,
+                                inserted, updates, restore)
+                elif rel.direction is ONETOMANY:
+                    pairs = [(r, l) for l, r in rel.local_remote_pairs]
+
+                    for child in value:
+                        self.__link(child, obj, pairs, inserted, updates, restore)
+
+        # Write the rows, parents first
+        nrows = 0
+
+        for table in Base.metadata.sorted_tables:
+            rows = [self.__to_row(obj) for obj in new.get(table, [])]
+            nrows += self.__execute_many(conn, table.insert(), rows, batch_size)
+
+            stmt = table.update().where(table.c.id == bindparam('_id'))
+            rows = []
+
+            for obj_id, values in updates.get(table, {}).items():
+                values['_id'] = obj_id
+                rows.append(values)
+            nrows += self.__execute_many(conn, stmt, rows, batch_size)
+
+        return nrows
+
     def clear(self):
         session = self._Session()
 
@@ -371,6 +1183,241 @@ class Database(object):
             session.commit()
         session.close()
 
+    def high_water_marks(self):
+        """Returns the dates where the next update starts reading
+        messages and commits.
+
+        Messages are read again from the newest message stored or
+        from the oldest response to an orphan, if it is older, so
+        responses whose parents arrive later are threaded. Dates are
+        stored with a resolution of seconds, so other commits of the
+        same second as the newest one may not have been read yet.
+        The ids of the messages and the revisions of the commits
+        stored since those dates are returned too, under the keys
+        'threads_seen' and 'commits_seen'.
+        """
+        tables = self.MESSAGE_TABLES
+        c_t = Commit.__table__
+        o_t = Orphan.__table__
+
+        with self._engine.connect() as conn:
+            threads_date = self.__newest_message_date(conn)
+            orphans_date = conn.execute(select([func.min(o_t.c.date)])).scalar()
+
+            if threads_date and orphans_date:
+                threads_date = min(threads_date, orphans_date)
+
+            commits_date = conn.execute(select([func.max(c_t.c.committer_date)])).scalar()
+
+            threads_seen = set()
+
+            if threads_date:
+                for t in tables:
+                    query = select([t.c.message_id]).where(t.c.date >= threads_date)
+                    threads_seen.update(row[0] for row in conn.execute(query))
+
+            commits_seen = set()
+
+            if commits_date:
+                query = select([c_t.c.rev]).where(c_t.c.committer_date == commits_date)
+                commits_seen.update(row[0] for row in conn.execute(query))
+
+        return {'threads' : threads_date,
+                'threads_seen' : threads_seen,
+                'commits' : commits_date,
+                'commits_seen' : commits_seen}
+
+    def store_orphans(self, orphans, window):
+        """Replace the orphans stored.
+
+        `orphans` is a list of (message id, date) pairs, with the date
+        of the oldest response to each one. Orphans whose responses
+        are older than `window` (a `datetime.timedelta`) before the
+        newest message stored are not kept, so messages that will
+        never arrive don't hold back the next updates.
+        """
+        table = Orphan.__table__
+
+        with self._engine.connect() as conn:
+            newest = self.__newest_message_date(conn)
+
+            rows = [{'message_id' : msg_id, 'date' : date}
+                    for msg_id, date in orphans
+                    if date and newest and date >= newest - window]
+
+            with conn.begin():
+                conn.execute(table.delete())
+
+                if rows:
+                    conn.execute(table.insert(), rows)
+
+        return len(rows)
+
+    def __newest_message_date(self, conn):
+        dates = [conn.execute(select([func.max(t.c.date)])).scalar()
+                 for t in self.MESSAGE_TABLES]
+        dates = [d for d in dates if d]
+        return max(dates) if dates else None
+
+    def load_members(self):
+        """Returns a dict with the members stored, by email"""
+
+        table = Member.__table__
+
+        with self._engine.connect() as conn:
+            rows = conn.execute(select([table.c.id, table.c.email]))
+            return {email : Member(id=mid, email=email) for mid, email in rows}
+
+    def load_patch_series(self):
+        """Returns a list with the patch series stored.
+
+        Each item is a pair with the series and the email of one
+        of the submitters of its patches.
+        """
+        ps_t = PatchSeries.__table__
+        psv_t = PatchSeriesVersion.__table__
+        p_t = Patch.__table__
+        m_t = Member.__table__
+
+        joins = ps_t.outerjoin(psv_t, psv_t.c.ps_id == ps_t.c.id) \
+            .outerjoin(p_t, p_t.c.ps_version_id == psv_t.c.id) \
+            .outerjoin(m_t, m_t.c.id == p_t.c.submitter_id)
+        query = select([ps_t.c.id, ps_t.c.message_id, ps_t.c.subject,
+                        func.min(m_t.c.email)]) \
+            .select_from(joins) \
+            .group_by(ps_t.c.id, ps_t.c.message_id, ps_t.c.subject) \
+            .order_by(ps_t.c.id)
+
+        with self._engine.connect() as conn:
+            return [(PatchSeries(id=psid, message_id=msg_id, subject=subject), email)
+                    for psid, msg_id, subject, email in conn.execute(query)]
+
+    def load_commits(self):
+        """Returns the list of commits stored"""
+
+        table = Commit.__table__
+        query = select([table.c.id, table.c.rev, table.c.subject,
+                        table.c.author_date, table.c.committer_date]) \
+            .order_by(table.c.committer_date)
+
+        with self._engine.connect() as conn:
+            return [Commit(id=cid, rev=rev, subject=subject,
+                           author_date=author_date, committer_date=committer_date)
+                    for cid, rev, subject, author_date, committer_date
+                    in conn.execute(query)]
+
+    def find_patches(self, msg_ids, chunk_size=1000):
+        """Returns the patches stored that were sent or commented
+        on the given messages, by message id.
+
+        Versions of patch series sent with a cover letter on any of
+        the messages are returned too, by the id of the cover letter.
+        """
+        p_t = Patch.__table__
+        c_t = Comment.__table__
+        psv_t = PatchSeriesVersion.__table__
+        columns = [p_t.c.id, p_t.c.message_id, p_t.c.subject,
+                   p_t.c.date, p_t.c.commit_id]
+
+        msg_ids = list(msg_ids)
+        patches = {}
+        found = {}
+
+        with self._engine.connect() as conn:
+            for i in range(0, len(msg_ids), chunk_size):
+                chunk = msg_ids[i:i + chunk_size]
+
+                queries = [select([p_t.c.message_id.label('key')] + columns)
+                           .where(p_t.c.message_id.in_(chunk)),
+                           select([c_t.c.message_id] + columns)
+                           .select_from(c_t.join(p_t, c_t.c.patch_id == p_t.c.id))
+                           .where(c_t.c.message_id.in_(chunk))]
+
+                for query in queries:
+                    for row in conn.execute(query):
+                        found[row[0]] = self.__to_patch(row[1:], patches)
+
+                query = select([psv_t.c.id, psv_t.c.message_id, psv_t.c.version,
+                                psv_t.c.subject, psv_t.c.date]) \
+                    .where(psv_t.c.message_id.in_(chunk))
+
+                # Versions sent without a cover letter were found by
+                # the message of their patch
+                for psvid, msg_id, version, subject, date in conn.execute(query):
+                    if msg_id not in found:
+                        found[msg_id] = PatchSeriesVersion(id=psvid, message_id=msg_id,
+                                                           version=version,
+                                                           subject=subject, date=date)
+
+        return found
+
+    def load_unlinked_patches(self):
+        """Returns the patches stored that were not linked to a commit"""
+
+        p_t = Patch.__table__
+        query = select([p_t.c.id, p_t.c.message_id, p_t.c.subject,
+                        p_t.c.date, p_t.c.commit_id]) \
+            .where(p_t.c.commit_id == None)
+
+        with self._engine.connect() as conn:
+            return [self.__to_patch(row, {}) for row in conn.execute(query)]
+
+    @staticmethod
+    def __to_patch(row, patches):
+        pid, msg_id, subject, date, commit_id = row
+
+        if pid not in patches:
+            patches[pid] = Patch(id=pid, message_id=msg_id, subject=subject,
+                                 date=date, commit_id=commit_id)
+        return patches[pid]
+
+    @staticmethod
+    def __execute_many(conn, stmt, rows, batch_size):
+        for i in range(0, len(rows), batch_size):
+            conn.execute(stmt, rows[i:i + batch_size])
+        return len(rows)
+
+    @staticmethod
+    def __lock_tables(conn):
+        # LOCK TABLES commits the open transaction, so it has to be
+        # run before starting the one that writes the rows
+        if conn.dialect.name == 'mysql':
+            tables = ', '.join('%s WRITE' % t.name for t in Base.metadata.sorted_tables)
+            conn.execute('LOCK TABLES ' + tables)
+
+    @staticmethod
+    def __unlock_tables(conn):
+        if conn.dialect.name == 'mysql':
+            conn.execute('UNLOCK TABLES')
+
+    @staticmethod
+    def __link(child, parent, pairs, inserted, updates, restore):
+        """Set the columns of child that reference parent"""
+
+        child_mapper = instance_state(child).mapper
+        parent_mapper = instance_state(parent).mapper
+
+        for child_col, parent_col in pairs:
+            key = child_mapper.get_property_by_column(child_col).key
+            value = getattr(parent, parent_mapper.get_property_by_column(parent_col).key)
+
+            if getattr(child, key) == value:
+                continue
+
+            if id(child) not in inserted:
+                restore.append((child, key, getattr(child, key)))
+
+                table = child_mapper.local_table
+                updates.setdefault(table, {}).setdefault(child.id, {})[child_col.key] = value
+
+            setattr(child, key, value)
+
+    @staticmethod
+    def __to_row(obj):
+        mapper = instance_state(obj).mapper
+        return {prop.columns[0].key : getattr(obj, prop.key)
+                for prop in mapper.column_attrs}
+
 
 class DatabaseError(Exception):
     """Database error exception"""
@@ -385,6 +1432,100 @@ class DatabaseError(Exception):
                                               'code' : self.code}
 
 
+class TrailerScanner(object):
+    """Extract trailers (Acked-by, Signed-off-by, ...) from messages.
+
+    Tags are given as a dict of tag names and the regular expressions
+    that match them at the beginning of a line (i.e '[Ff]rom' for
+    'From'). All the tags are compiled in a single expression, so a
+    body is scanned once whatever the number of registered tags.
+    """
+
+    def __init__(self, tags):
+        self.tags = {}
+        self._regex = None
+
+        for name, pattern in tags.items():
+            self.register(name, pattern)
+
+    def register(self, name, pattern=None):
+        """Register a new tag. By default, the name is the pattern."""
+
+        self.tags[name] = pattern or re.escape(name)
+        self._regex = None
+
+    def scan(self, body):
+        """Returns the list of (tag, value) pairs found on the body"""
+
+        if self._regex is None:
+            self._compile()
+
+        trailers = []
+
+        for m in self._regex.finditer(body):
+            name, value_group = self._groups[m.lastgroup]
+            trailers.append((name, m.group(value_group)))
+
+        return trailers
+
+    def _compile(self):
+        # Each tag is matched by a named group that encloses its value,
+        # so it is the last group closed on a match and `lastgroup`
+        # finds the tag whatever the groups of the patterns are
+        self._groups = {}
+        alternatives = []
+
+        for i, name in enumerate(sorted(self.tags)):
+            self._groups['tag%d' % i] = (name, 'value%d' % i)
+            alternatives.append('(?P<tag%d>(?:%s):(?P<value%d>.+))' % (i, self.tags[name], i))
+
+        regex = '^(?:%s)$' % '|'.join(alternatives)
+
+        self._regex = re.compile(regex, re.MULTILINE)
+
+
+class CommitIndex(object):
+    """Index of commits by subject key.
+
+    Several commits may share the same key (i.e, the same change
+    applied to different branches). All of them are kept and, when
+    matching a patch, the one authored closest to the date of the
+    patch is chosen.
+    """
+
+    def __init__(self):
+        self._commits = {}
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, commit, key=None):
+        if key is None:
+            key = to_key(commit.subject)
+
+        self._commits.setdefault(key, []).append(commit)
+        self._size += 1
+
+    def match(self, key, date=None):
+        """Returns the best commit for a key or None"""
+
+        candidates = self._commits.get(key, None)
+
+        if not candidates:
+            return None
+        elif len(candidates) == 1 or date is None:
+            return candidates[-1]
+
+        def distance(commit):
+            commit_date = commit.author_date or commit.committer_date
+            return abs(commit_date - date) if commit_date else datetime.timedelta.max
+
+        return min(candidates, key=distance)
+
+    def values(self):
+        return [c for candidates in self._commits.values() for c in candidates]
+
 
 class PatchesParser(object):
 
@@ -392,95 +1533,305 @@ class PatchesParser(object):
     #PATCH_REGEX = '^.*\[PATCH\s*(?:\s+for[\-\s]\d+\.\d+)?\s*(?:[vV](?P<version>\d+))?\s*(?:(?P<num>\d+)/(?P<total>\d+))?\]\s*(?P<subject>.+)$'
     TYPE = '(OSSTEST|MINI-OS|raisin|iommu|OPW|ARM)*'
     PATCH_REGEX = '^.*\[\s*'+TYPE+'\s*PATCH\s*'+TYPE+'\s*(?:\s+for[\-\s]\d+\.\d+)?\s*(?:[vV](?P<version>\d+))?\s*(?:(?P<num>\d+)/(?P<total>\d+))?\]\s*(?P<subject>.+)$'
-    FLAGS_REGEX = {
-                   'Acked-by' : '^Acked-by:(?P<value>.+)$',
-                   'Cc' : '^Cc:(?P<value>.+)',
-                   'Fixes' : '^Fixes:(?P<value>.+)$',
-                   'From' : '^[Ff]rom:(?P<value>.+)$',
-                   'Reported-by' : '^Reported-by:(?P<value>.+)$',
-                   'Tested-by' : '^Tested-by:(?P<value>.+)$',
-                   'Reviewed-by' : '^Reviewed-by:(?P<value>.+)$',
-                   'Release-Acked-by' : '^Release-Acked-by:(?P<value>.+)$',
-                   'Signed-off-by' : '^Signed-off-by:(?P<value>.+)$',
-                   'Suggested-by' : '^Suggested-by:(?P<value>.+)$',
-                   }
-
-    def __init__(self):
+    FLAGS = {
+             'Acked-by' : 'Acked-by',
+             'Cc' : 'Cc',
+             'Fixes' : 'Fixes',
+             'From' : '[Ff]rom',
+             'Reported-by' : 'Reported-by',
+             'Tested-by' : 'Tested-by',
+             'Reviewed-by' : 'Reviewed-by',
+             'Release-Acked-by' : 'Release-Acked-by',
+             'Signed-off-by' : 'Signed-off-by',
+             'Suggested-by' : 'Suggested-by',
+             }
+
+    def __init__(self, flags=None, series_by_submitter=False, stats=None):
+        self.stats = stats or Instrumentation()
         self.members = {}
-        self.commits = {}
-
-    def parse(self, threads, commits):
-        """Parse a list of threads"""
+        self.commits = CommitIndex()
+        self.series = {}
+        self.series_by_submitter = series_by_submitter
+        self.trailers = TrailerScanner(flags or self.FLAGS)
+
+    def parse(self, threads, commits, processes=None, chunk_size=100):
+        """Parse a list of threads.
+
+        Returns the commits and the list of patch series found; each
+        series appears once, whatever the number of versions sent.
+        Series indexed from previous runs are included when they
+        receive new versions.
+
+        When `processes` is given, threads are parsed in chunks of
+        `chunk_size` by a pool of that number of processes. Workers
+        only return plain tuples; the objects of the model, members
+        and links to commits are created afterwards, in the same
+        order the serial parsing does, so the output is the same.
+        """
 
         patches_series = []
+        listed = set()
 
-        self.commits = self.__parse_commits(commits)
-
-        for th in threads:
-            root = th.root
+        parsed_commits = self.__parse_commits(commits)
 
-            m = re.match(self.THREAD_REGEX, root.subject)
+        if processes:
+            parsed = (self.__build_version(data)
+                      for data in self.__parse_threads_in_pool(threads, processes,
+                                                               chunk_size))
+        else:
+            parsed = (self.parse_thread(th) for th in threads)
 
-            if not m:
-                print "ERROR: not valid thread - %s" % root.subject
+        for result in parsed:
+            if result is None:
                 continue
 
-            try:
-                parts = self.__parse_patch_subject(root)
-            except Exception, e:
-                print "Thread error", e
-                continue
+            parts, psv, keys = result
 
-            patches = []
+            for patch, key in zip(psv.patches, keys):
+                commit = self.commits.match(key, patch.date)
 
-            if parts['num'] == 0:
-                for msg in root.responses:
-                    try:
-                        patch = self.__parse_patch(msg)
-                        patches.append(patch)
-                    except Exception, e:
-                        print e
-                        continue
-            else:
-                try:
-                    patch = self.__parse_patch(root)
-                    patches.append(patch)
-                except Exception, e:
-                    print e
-                    continue
+                if commit:
+                    commit.patches.append(patch)
+                    self.stats.incr('patches_linked')
 
-            # New patch series
-            psv = PatchSeriesVersion(version=parts['version'],
-                                     subject=root.subject,
-                                     body=root.body,
-                                     date=root.date,
-                                     date_tz=root.date_tz)
+                self.stats.incr('patches')
+                self.stats.incr('comments', len(patch.comments))
+                self.stats.incr('flags', len(patch.flags))
 
-            for p in patches:
-                psv.patches.append(p)
+            self.stats.incr('threads')
 
             # Find the patch series
             ps = None
+            key = self.__series_key(parts['subject'], parts['sender'])
 
             if parts['version'] > 1:
-                for o in patches_series:
-                    if o.subject == parts['subject']:
-                        ps = o
-                        break
+                ps = self.series.get(key, None)
 
             # Not found, so create a new one
             if ps is None:
                 # root message_id
-                root_message_id = root.msg_id
+                root_message_id = parts['msg_id']
                 ps = PatchSeries(message_id=root_message_id,
                                  subject=parts['subject'])
+                self.series.setdefault(key, ps)
 
             ps.versions.append(psv)
 
-            patches_series.append(ps)
+            if id(ps) not in listed:
+                listed.add(id(ps))
+                patches_series.append(ps)
+
+        self.stats.incr('patch_series', len(patches_series))
+        self.stats.incr('commits', len(parsed_commits))
+        self.stats.incr('commits_unmatched',
+                        len([c for c in parsed_commits if not c.patches]))
 
         return self.commits, patches_series
 
+    def parse_thread(self, th):
+        """Parse the patch series version sent on a thread.
+
+        Returns the parts of the subject of the thread, the version
+        of the series and the commit keys of its patches, or None
+        when the thread is not valid. Patches are not linked to
+        commits.
+        """
+        return self.__build_version(self.parse_thread_data(th))
+
+    def parse_thread_data(self, th):
+        """Parse a thread as `parse_thread` does, but returning the
+        version of the series and its patches as plain tuples, which
+        are cheap to send between processes"""
+
+        root = th.root
+
+        m = re.match(self.THREAD_REGEX, root.subject)
+
+        if not m:
+            print "ERROR: not valid thread - %s" % root.subject
+            self.stats.incr('errors.invalid_thread')
+            return None
+
+        try:
+            parts = self.__parse_patch_subject(root)
+        except Exception, e:
+            print "Thread error", e
+            self.stats.incr('errors.thread_subject')
+            return None
+
+        parts['msg_id'] = root.msg_id
+        parts['sender'] = root.sender
+
+        patches = []
+        keys = []
+
+        if parts['num'] == 0:
+            for msg in root.responses:
+                try:
+                    patches.append(self.__patch_data(msg))
+                except Exception, e:
+                    print e
+                    self.stats.incr('errors.patch')
+                    continue
+        else:
+            try:
+                patches.append(self.__patch_data(root))
+            except Exception, e:
+                print e
+                self.stats.incr('errors.patch')
+                return None
+
+        version = (root.msg_id, parts['version'], root.subject, root.body,
+                   root.date, root.date_tz)
+
+        return parts, version, patches
+
+    def index_series(self, ps, sender=None):
+        """Make a patch series, parsed in a previous run, available
+        to link the new versions found"""
+
+        key = self.__series_key(ps.subject, sender)
+        self.series.setdefault(key, ps)
+
+    def index_commits(self, commits):
+        """Make commits, parsed in a previous run, available to link
+        the new patches found"""
+
+        for commit in commits:
+            self.commits.add(commit)
+
+    def attach_responses(self, orphans, patches):
+        """Attach responses to patches parsed in a previous run.
+
+        `orphans` are messages that were not received but their
+        responses were. `patches` is a dict of patches by the id
+        of the message of the patch, or of any of its comments, as
+        returned by `Database.find_patches`. Responses to the cover
+        letter of a version of a series are added to that version
+        as patches.
+
+        Returns the list of patches and versions updated.
+        """
+        updated = []
+
+        for orphan in orphans:
+            patch = patches.get(orphan.msg_id, None)
+
+            if patch is None:
+                continue
+
+            if isinstance(patch, PatchSeriesVersion):
+                if self.__attach_patches(patch, orphan.responses) and \
+                        patch not in updated:
+                    updated.append(patch)
+                continue
+
+            comments, flags = self.__parse_responses(orphan)
+
+            for c in comments:
+                patch.comments.append(c)
+            for f in flags:
+                patch.flags.append(f)
+
+            if patch not in updated:
+                updated.append(patch)
+
+        return updated
+
+    def __attach_patches(self, psv, msgs):
+        """Add the patches sent on `msgs` to a version of a series
+        parsed in a previous run. Returns whether any was added."""
+
+        added = False
+
+        for msg in msgs:
+            try:
+                patch, key = self.__parse_patch(msg)
+            except Exception, e:
+                print e
+                self.stats.incr('errors.patch')
+                continue
+
+            psv.patches.append(patch)
+            added = True
+
+            commit = self.commits.match(key, patch.date)
+
+            if commit:
+                commit.patches.append(patch)
+                self.stats.incr('patches_linked')
+
+        return added
+
+    def link_commits(self, patches):
+        """Link patches parsed in a previous run to the commits parsed.
+
+        Returns the list of patches linked.
+        """
+        linked = []
+
+        for patch in patches:
+            try:
+                parts = self.__parse_patch_subject(patch)
+            except Exception:
+                continue
+
+            commit = self.commits.match(to_key(parts['subject']), patch.date)
+
+            if commit:
+                commit.patches.append(patch)
+                linked.append(patch)
+
+        return linked
+
+    def __parse_threads_in_pool(self, threads, processes, chunk_size):
+        """Parse threads on a pool of processes, keeping their order.
+
+        Generates the results of `parse_thread_data`.
+        """
+
+        def chunks():
+            chunk = []
+
+            for th in threads:
+                chunk.append(th)
+
+                if len(chunk) == chunk_size:
+                    yield self.trailers.tags, chunk
+                    chunk = []
+            if chunk:
+                yield self.trailers.tags, chunk
+
+        pool = multiprocessing.Pool(processes)
+
+        try:
+            for results, counters in pool.imap(_parse_threads, chunks()):
+                self.stats.merge(counters)
+
+                for result in results:
+                    yield result
+        finally:
+            pool.terminate()
+
+    def __get_member(self, email):
+        member = self.members.get(email, None)
+
+        if not member:
+            member = Member(email=email)
+            self.members[member.email] = member
+
+        return member
+
+    def __series_key(self, subject, sender):
+        """Key used to link the versions of a patch series"""
+
+        key = ' '.join(subject.lower().split())
+
+        if self.series_by_submitter:
+            key = (key, sender)
+
+        return key
+
     def __parse_patch_subject(self, patch):
         """Parse and split patch subject"""
 
@@ -497,89 +1848,102 @@ class PatchesParser(object):
                 'total'   : to_int(m.group('total'), None)}
 
     def __parse_patch(self, msg):
-        """Get the patch from a message"""
+        """Get the patch from a message and its commit key"""
 
-        parts = self.__parse_patch_subject(msg)
+        return self.__build_patch(self.__patch_data(msg))
 
-        patch = Patch(message_id = msg.msg_id, subject=msg.subject,
-                      body=msg.body, series=parts['num'],
-                      total=parts['total'], date=msg.date,
-                      date_tz=msg.date_tz)
+    def __patch_data(self, msg):
+        """Parse a patch and its responses as plain tuples"""
 
-        member = self.members.get(msg.sender, None)
+        parts = self.__parse_patch_subject(msg)
 
-        if not member:
-            member = Member(email=msg.sender)
-            self.members[member.email] = member
+        flags = self.__parse_flags(msg)
+        comments, response_flags = self.__parse_responses_data(msg)
 
-        patch.submitter = member
+        return (msg.msg_id, msg.subject, msg.body, parts['num'], parts['total'],
+                msg.date, msg.date_tz, msg.sender, to_key(parts['subject']),
+                flags + response_flags, comments)
 
-        flags = self.__parse_flags(msg)
-        for f in flags:
-            patch.flags.append(f)
+    def __parse_responses(self, root):
+        """Parse responses from a list of nested messages"""
 
-        comments, flags = self.__parse_responses(msg)
+        comments, flags = self.__parse_responses_data(root)
 
-        for c in comments:
-            patch.comments.append(c)
-        for f in flags:
-            patch.flags.append(f)
+        return ([self.__build_comment(c) for c in comments],
+                [self.__build_flag(f) for f in flags])
 
-        key = to_key(parts['subject'])
+    def __parse_responses_data(self, root):
+        comments = []
+        flags = []
+        to_parse = collections.deque(root.responses)
 
-        commit = self.commits.get(key, None)
+        while to_parse:
+            m = to_parse.popleft()
+            to_parse.extend(m.responses)
 
-        if commit:
-            commit.patches.append(patch)
+            comments.append((m.msg_id, m.subject, m.body, m.date, m.date_tz,
+                             m.sender))
+            flags.extend(self.__parse_flags(m))
 
-        return patch
+        return comments, flags
 
-    def __parse_responses(self, root):
-        """Parse responses from a list of nested messages"""
+    def __parse_flags(self, msg):
+        """Parse flags from a messages"""
 
-        comments = []
-        flags = []
-        to_parse = root.responses[:]
+        return [(name, value, msg.date, msg.date_tz)
+                for name, value in self.trailers.scan(msg.body)]
 
-        while to_parse:
-            m = to_parse.pop(0)
-            to_parse.extend(m.responses[:])
+    def __build_version(self, data):
+        """Create the objects of a version parsed by `parse_thread_data`"""
 
-            comment = Comment(message_id=m.msg_id, subject=m.subject,
-                              body=m.body, date=m.date, date_tz=m.date_tz)
-            member = self.members.get(m.sender, None)
+        if data is None:
+            return None
 
-            if not member:
-                member = Member(email=m.sender)
-                self.members[member.email] = member
+        parts, version, patches = data
+        msg_id, number, subject, body, date, date_tz = version
 
-            comment.submitter = member
+        psv = PatchSeriesVersion(message_id=msg_id, version=number,
+                                 subject=subject, body=body,
+                                 date=date, date_tz=date_tz)
+        keys = []
 
-            comments.append(comment)
+        for patch_data in patches:
+            patch, key = self.__build_patch(patch_data)
+            psv.patches.append(patch)
+            keys.append(key)
 
-            fgs = self.__parse_flags(m)
-            flags.extend(fgs)
+        return parts, psv, keys
 
-        return comments, flags
+    def __build_patch(self, data):
+        msg_id, subject, body, num, total, date, date_tz, sender, key, \
+            flags, comments = data
 
-    def __parse_flags(self, msg):
-        """Parse flags from a messages"""
+        patch = Patch(message_id=msg_id, subject=subject, body=body,
+                      series=num, total=total, date=date, date_tz=date_tz)
+        patch.submitter = self.__get_member(sender)
 
-        flags = []
-        lines = msg.body.split('\n')
+        for c in comments:
+            patch.comments.append(self.__build_comment(c))
+        for f in flags:
+            patch.flags.append(self.__build_flag(f))
+
+        return patch, key
 
-        for l in lines:
-            for name in self.FLAGS_REGEX:
-                m = re.match(self.FLAGS_REGEX[name], l)
+    def __build_comment(self, data):
+        msg_id, subject, body, date, date_tz, sender = data
 
-                if m:
-                    flag = Flag(flag=name, value=m.group('value'), date=msg.date, date_tz =msg.date_tz)
-                    flags.append(flag)
+        comment = Comment(message_id=msg_id, subject=subject, body=body,
+                          date=date, date_tz=date_tz)
+        comment.submitter = self.__get_member(sender)
+        return comment
 
-        return flags
+    @staticmethod
+    def __build_flag(data):
+        name, value, date, date_tz = data
+        return Flag(flag=name, value=value, date=date, date_tz=date_tz)
 
     def __parse_commits(self, scm_logs):
-        commits = {}
+        commits = []
 
         for log in scm_logs:
             subject = log.message.split('\n')[0].strip()
@@ -590,49 +1954,157 @@ class PatchesParser(object):
                             author_date_tz=log.author_date_tz,
                             committer_date_tz=log.commit_date_tz)
 
-            author = self.members.get(log.author, None)
+            commit.author = self.__get_member(log.author)
+            commit.committer = self.__get_member(log.committer)
 
-            if not author:
-                author = Member(email=log.author)
-                self.members[author.email] = author
+            self.commits.add(commit, to_key(subject))
+            commits.append(commit)
 
-            committer = self.members.get(log.committer, None)
+        return commits
 
-            if not committer:
-                committer = Member(email=log.committer)
-                self.members[committer.email] = committer
 
-            commit.author = author
-            commit.committer = committer
+def _oldest_response(orphan):
+    """Returns the date of the oldest response to an orphan"""
 
-            key = to_key(subject)
+    dates = []
+    to_visit = list(orphan.responses)
 
-            commits[key] = commit
+    while to_visit:
+        msg = to_visit.pop()
+        dates.append(msg.date)
+        to_visit.extend(msg.responses)
+
+    dates = [d for d in dates if d]
+    return min(dates) if dates else None
+
+
+def _parse_threads(args):
+    """Parse a chunk of threads on a worker process"""
+
+    flags, threads = args
+    parser = PatchesParser(flags=flags)
+    results = [parser.parse_thread_data(th) for th in threads]
+
+    return results, parser.stats.counters
+
+
+# Responses are usually sent after their parents, but not always
+ORPHAN_WINDOW = datetime.timedelta(days=7)
+
+KEY_STRIP_CHARS = '/ \n\t._'
+KEY_STRIP_UNICODE = tuple(unicode(c) for c in KEY_STRIP_CHARS)
 
-        return commits
 
 def to_key(s):
-    import nltk
-    import string
+    """Normalize a subject to match patches and commits"""
 
-    key = s.lower()
-    key = key.replace('"', "'")
+    key = s.lower().replace('"', "'")
     key = key[:-1] if key.endswith('.') else key
     key = key[key.rfind(': ') + 2:]
-    key = key.replace('/', "")
-    key = key.replace(" ", "")
-    key = key.replace('\n', "")
-    key = key.replace('\t', "")
-    key = key.replace('.', "")
-    key = key.replace("_", "")
-    key = key.lstrip()
-    key = key.rstrip()
 
-    #punctuations = list(string.punctuation)
-    #for punctuation in punctuations:
-    #    key = key.replace(punctuation, "")
+    # translate() deletes all the characters of a str in a single pass;
+    # on unicode it looks up every character in a dict, so replace()
+    # is faster there; it copies the string even when the character
+    # is not found, so it's only called for the ones in the key
+    if isinstance(key, str):
+        key = key.translate(None, KEY_STRIP_CHARS)
+    else:
+        for c in KEY_STRIP_UNICODE:
+            if c in key:
+                key = key.replace(c, u'')
+
+    return key.strip()
+
+
+# Columnar export
+
+PARQUET_TABLES = {
+    'patch_series' : ['id', 'message_id', 'subject'],
+    'patch_series_version' : ['id', 'ps_id', 'version', 'subject',
+                              'date', 'date_tz'],
+    'patches' : ['id', 'ps_version_id', 'message_id', 'subject', 'series',
+                 'total', 'date', 'date_tz', 'submitter', 'commit_id'],
+    'comments' : ['id', 'patch_id', 'message_id', 'subject', 'date',
+                  'date_tz', 'submitter'],
+    'flags' : ['id', 'patch_id', 'flag', 'value', 'date', 'date_tz'],
+    'commits' : ['id', 'rev', 'subject', 'author', 'committer',
+                 'author_date', 'author_date_tz', 'committer_date',
+                 'committer_date_tz'],
+}
+
+PARQUET_DICTIONARY_COLUMNS = ['subject', 'submitter', 'author',
+                              'committer', 'flag', 'value']
+
+
+def export_parquet(patches_series, commits, path):
+    """Export patch series and commits to Parquet datasets.
+
+    Each table of the model is written to a dataset under `path`,
+    partitioned by the year of the date of its rows. Emails, subjects
+    and flags are dictionary encoded. Bodies are not exported.
+
+    Objects must have been stored before, so they have identifiers.
+    Existing datasets are replaced.
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("pyarrow is required to export to Parquet")
+
+    def value(obj, column):
+        v = getattr(obj, column)
+
+        # Members are exported by email
+        if isinstance(v, Member):
+            v = v.email
+
+        # Byte strings would be written as binary columns
+        if isinstance(v, str):
+            v = v.decode('utf-8', 'replace')
+        return v
+
+    rows = {name : [] for name in PARQUET_TABLES}
+
+    for ps in patches_series:
+        rows['patch_series'].append(ps)
+
+        for psv in ps.versions:
+            rows['patch_series_version'].append(psv)
+
+            for patch in psv.patches:
+                rows['patches'].append(patch)
+                rows['comments'].extend(patch.comments)
+                rows['flags'].extend(patch.flags)
+
+    rows['commits'].extend(commits)
+
+    for name, columns in PARQUET_TABLES.items():
+        objs = rows[name]
+        arrays = []
+
+        for column in columns:
+            column_array = pyarrow.array([value(o, column) for o in objs])
+
+            if column in PARQUET_DICTIONARY_COLUMNS:
+                column_array = column_array.dictionary_encode()
+            arrays.append(column_array)
+
+        date_column = 'committer_date' if name == 'commits' else 'date'
+        dates = [getattr(o, date_column, None) for o in objs]
+        arrays.append(pyarrow.array([d.year if d else 0 for d in dates],
+                                    type=pyarrow.int16()))
+
+        table = pyarrow.Table.from_arrays(arrays, names=columns + ['year'])
+
+        dataset = os.path.join(path, name)
+
+        if os.path.exists(dataset):
+            shutil.rmtree(dataset)
+
+        pyarrow.parquet.write_to_dataset(table, dataset,
+                                         partition_cols=['year'])
 
-    return key
 
 def parse_args():
     parser = ArgumentParser(usage="Usage: '%(prog)s [options] <threads_db>")
@@ -653,6 +2125,34 @@ def parse_args():
     group.add_argument('--port', dest='db_port',
                        help='Port of the host where the database server is running',
                        default='3306')
+    group.add_argument('--pool-size', dest='pool_size', type=int, default=5,
+                       help='Number of connections kept open per database')
+
+    # Update options
+    parser.add_argument('--incremental', dest='incremental', action='store_true',
+                        help='Only add the messages and commits newer than the stored ones')
+
+    # Export options
+    parser.add_argument('--parquet', dest='parquet', default=None,
+                        help='Directory where Parquet datasets will be exported')
+
+    # Instrumentation options
+    parser.add_argument('--report', dest='report', default=None,
+                        help='File where the JSON report of the run will be written; stderr by default')
+    parser.add_argument('--profile', dest='profile', default=None,
+                        help='File where cProfile stats of the run will be written')
+
+    # Parsing options
+    parser.add_argument('--processes', dest='processes', type=int, default=None,
+                        help='Number of processes used to parse the threads')
+    parser.add_argument('--thread-timeout', dest='thread_timeout', type=int, default=0,
+                        help='Days without messages after which a thread is closed to '
+                             'save memory; later responses to it are lost. By default, '
+                             'every thread is kept open until the end')
+    parser.add_argument('--orphan-window', dest='orphan_window', type=int,
+                        default=ORPHAN_WINDOW.days,
+                        help='Days that responses to messages not found yet are read '
+                             'again by the next incremental updates')
 
     # Positional arguments
     parser.add_argument('threads_db', help='Threads database')
@@ -661,36 +2161,133 @@ def parse_args():
     # Parse arguments
     args = parser.parse_args()
 
+    if args.parquet and args.incremental:
+        parser.error("Parquet datasets can only be exported on full updates")
+
     return args
 
 
+def update(db, threads_conn, commits_conn, incremental=False, timeout=None,
+           orphan_window=ORPHAN_WINDOW, processes=None, stats=None):
+    """Parse the threads and commits not stored yet and store them.
+
+    On incremental updates, messages and commits are read from the
+    high-water marks of `db` and responses to stored patches are
+    attached to them; otherwise, `db` is cleared first. Orphans whose
+    responses are newer than `orphan_window` are stored, so the next
+    update reads their responses again.
+
+    Returns the patch series and the commits parsed.
+    """
+    stats = stats or Instrumentation()
+
+    if incremental:
+        marks = db.high_water_marks()
+    else:
+        with stats.stage('clear'):
+            db.clear()
+        marks = {}
+
+    # Read again from the marks, skipping what was stored
+    from_date = lambda d: d if d else "2010-01-01"
+
+    orphans = []
+    builder = ThreadBuilder()
+    parser = PatchesParser(stats=stats)
+
+    if incremental:
+        with stats.stage('load_stored'):
+            parser.members.update(db.load_members())
+            parser.index_commits(db.load_commits())
+
+            for ps, sender in db.load_patch_series():
+                parser.index_series(ps, sender)
+
+    # Threads and commits are retrieved while they are parsed,
+    # so only the threads still open are kept in memory
+    threads = iter_patch_threads(threads_conn, from_date(marks.get('threads')),
+                                 "2100-01-01", timeout=timeout,
+                                 orphans=orphans, builder=builder,
+                                 skip=marks.get('threads_seen'))
+    threads = stats.timed('retrieve_threads', threads)
+
+    commits = iter_commits(commits_conn, from_date(marks.get('commits')),
+                           "2100-01-01", skip=marks.get('commits_seen'))
+    commits = stats.timed('retrieve_commits', commits)
+
+    with stats.stage('parse'):
+        commits, patches_series = parser.parse(threads, commits,
+                                               processes=processes)
+
+    summary = builder.summary()
+    stats.incr('threads_retrieved', summary['threads'])
+    stats.incr('messages_retrieved', summary['messages'])
+    stats.gauge('max_thread_size', summary['max_thread_size'])
+    stats.gauge('max_thread_depth', summary['max_thread_depth'])
+
+    patches = {}
+    updated = []
+
+    if incremental:
+        with stats.stage('attach'):
+            patches = db.find_patches([o.msg_id for o in orphans])
+            updated = parser.attach_responses(orphans, patches)
+
+            linked = parser.link_commits(db.load_unlinked_patches())
+
+        stats.incr('patches_updated', len(updated))
+        stats.incr('patches_linked', len(linked))
+
+    stats.incr('orphans', len(orphans))
+
+    with stats.stage('store'):
+        nrows, secs = db.store_many(patches_series + commits.values() + updated)
+
+        unresolved = [(o.msg_id, _oldest_response(o)) for o in orphans
+                      if o.msg_id not in patches]
+        stats.incr('orphans_pending', db.store_orphans(unresolved, orphan_window))
+
+    print "%(rows)s rows stored in %(secs).2fs (%(rate).2f rows/sec)" % \
+        {'rows' : nrows, 'secs' : secs, 'rate' : nrows / secs if secs else 0}
+    stats.incr('rows_stored', nrows)
+
+    return patches_series, commits.values()
+
+
 def main():
     args = parse_args()
+    stats = Instrumentation(profile=bool(args.profile))
+
+    manager = ConnectionManager(args.db_user, args.db_password,
+                                args.db_hostname, args.db_port,
+                                pool_size=args.pool_size)
 
     try:
         db = Database(args.db_user, args.db_password, args.db_name,
-                      args.db_hostname, args.db_port)
+                      args.db_hostname, args.db_port, manager=manager)
     except DatabaseError, e:
         raise RuntimeError(str(e))
 
-    conn = MySQLdb.connect(user=args.db_user, passwd=args.db_password,
-                           db=args.threads_db)
-    threads = retrieve_patch_threads(conn, "2010-01-01", "2100-01-01")
+    if args.thread_timeout:
+        timeout = datetime.timedelta(days=args.thread_timeout)
+    else:
+        timeout = None
 
-    conn = MySQLdb.connect(user=args.db_user, passwd=args.db_password,
-                           db=args.commits_db)
-    commits = retrieve_commits(conn, "2010-01-01", "2100-01-01")
+    with manager.connection(args.threads_db) as threads_conn, \
+            manager.connection(args.commits_db) as commits_conn:
+        patches_series, commits = update(db, threads_conn, commits_conn,
+                                         incremental=args.incremental,
+                                         timeout=timeout,
+                                         orphan_window=datetime.timedelta(days=args.orphan_window),
+                                         processes=args.processes, stats=stats)
 
-    parser = PatchesParser()
-    commits, patches_series = parser.parse(threads, commits)
+    if args.parquet:
+        with stats.stage('export_parquet'):
+            export_parquet(patches_series, commits, args.parquet)
 
-    db.clear()
-    session = db.connect()
+    manager.dispose()
 
-    for ps in patches_series:
-        db.store(session, ps)
-    for c in commits.values():
-        db.store(session, c)
+    stats.dump(args.report, args.profile)
 
 
 if __name__ == '__main__':
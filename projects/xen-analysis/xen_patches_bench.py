@@ -0,0 +1,485 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014-2015 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+"""Benchmarks for xen_patches.
+
+Besides micro-benchmarks for the hot paths, the whole pipeline can be
+measured against a synthetic archive of threads and commits stored in
+SQLite databases that stand in for the mlstats and CVSAnalY ones.
+"""
+
+import datetime
+import os
+import random
+import re
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from argparse import ArgumentParser
+
+from xen_patches import CommitIndex, Commit, Database, Instrumentation, \
+    PatchesParser, TrailerScanner, iter_commits, retrieve_patch_threads, \
+    to_key
+
+
+# Flags parser used before TrailerScanner, kept as baseline
+LEGACY_FLAGS_REGEX = {
+                      'Acked-by' : '^Acked-by:(?P<value>.+)$',
+                      'Cc' : '^Cc:(?P<value>.+)',
+                      'Fixes' : '^Fixes:(?P<value>.+)$',
+                      'From' : '^[Ff]rom:(?P<value>.+)$',
+                      'Reported-by' : '^Reported-by:(?P<value>.+)$',
+                      'Tested-by' : '^Tested-by:(?P<value>.+)$',
+                      'Reviewed-by' : '^Reviewed-by:(?P<value>.+)$',
+                      'Release-Acked-by' : '^Release-Acked-by:(?P<value>.+)$',
+                      'Signed-off-by' : '^Signed-off-by:(?P<value>.+)$',
+                      'Suggested-by' : '^Suggested-by:(?P<value>.+)$',
+                      }
+
+
+def legacy_scan(body):
+    trailers = []
+
+    for l in body.split('\n'):
+        for name in LEGACY_FLAGS_REGEX:
+            m = re.match(LEGACY_FLAGS_REGEX[name], l)
+
+            if m:
+                trailers.append((name, m.group('value')))
+
+    return trailers
+
+
+def legacy_to_key(s):
+    # Same as the previous to_key() without the imports of nltk
+    # and string, that were not used
+    key = s.lower()
+    key = key.replace('"', "'")
+    key = key[:-1] if key.endswith('.') else key
+    key = key[key.rfind(': ') + 2:]
+    key = key.replace('/', "")
+    key = key.replace(" ", "")
+    key = key.replace('\n', "")
+    key = key.replace('\t', "")
+    key = key.replace('.', "")
+    key = key.replace("_", "")
+    key = key.lstrip()
+    key = key.rstrip()
+
+    return key
+
+
+WORDS = ['xen', 'x86', 'arm', 'libxl', 'fix', 'add', 'remove', 'page',
+         'domain', 'vcpu', 'irq', 'p2m', 'hvm', 'support', 'for', 'the']
+
+
+def generate_subject(rnd):
+    prefix = rnd.choice(['', 'x86/mm: ', 'libxl: ', 'tools/xl: ', 'xen/arm: '])
+    words = ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(3, 9)))
+    return prefix + words + rnd.choice(['', '.', '_v2'])
+
+
+def generate_commits(rnd, ncommits, dup_ratio=0.2):
+    """Generate commits and the patches that were merged as them.
+
+    A share of the subjects is reused by later commits, as it
+    happens with backports to stable branches.
+    """
+    start = datetime.datetime(2010, 1, 1)
+    commits = []
+    patches = []
+
+    for i in range(ncommits):
+        date = start + datetime.timedelta(hours=i * 6)
+
+        if commits and rnd.random() < dup_ratio:
+            subject = rnd.choice(commits).subject
+        else:
+            subject = generate_subject(rnd)
+
+        commit = Commit(rev='%040x' % i, subject=subject,
+                        author_date=date, committer_date=date)
+        commits.append(commit)
+
+        version = rnd.randint(1, 4)
+        sent = date - datetime.timedelta(hours=rnd.randint(1, 72))
+        patches.append(('[PATCH v%d %d/%d] %s' % (version, 1, 3, subject), sent, commit))
+
+    return commits, patches
+
+
+def bench_keys(nsubjects, repeat, seed=0):
+    rnd = random.Random(seed)
+    subjects = [generate_subject(rnd) for _ in range(nsubjects)]
+    unicode_subjects = [s.decode('utf-8') for s in subjects]
+
+    print "Subject keys (%d subjects)" % nsubjects
+
+    for name, values in (('byte', subjects), ('unicode', unicode_subjects)):
+        for s in values:
+            assert legacy_to_key(s) == to_key(s)
+
+        legacy = timed(legacy_to_key, values, repeat)
+        current = timed(to_key, values, repeat)
+
+        print "  %s:" % name
+        print "    legacy:     %.3fs (%.0f keys/sec)" % (legacy, nsubjects / legacy)
+        print "    normalizer: %.3fs (%.0f keys/sec)" % (current, nsubjects / current)
+        print "    speedup:    %.1fx" % (legacy / current)
+
+
+def bench_matching(ncommits, seed=0):
+    rnd = random.Random(seed)
+    commits, patches = generate_commits(rnd, ncommits)
+
+    legacy = {}
+    index = CommitIndex()
+
+    for commit in commits:
+        legacy[legacy_to_key(commit.subject)] = commit
+        index.add(commit)
+
+    subject_regex = re.compile(PatchesParser.PATCH_REGEX)
+    legacy_hits = 0
+    index_hits = 0
+
+    for subject, date, expected in patches:
+        key = to_key(subject_regex.match(subject).group('subject'))
+
+        if legacy.get(key, None) is expected:
+            legacy_hits += 1
+        if index.match(key, date) is expected:
+            index_hits += 1
+
+    print "Patch to commit matching (%d patches)" % len(patches)
+    print "  legacy: %.2f%%" % (legacy_hits * 100.0 / len(patches))
+    print "  index:  %.2f%%" % (index_hits * 100.0 / len(patches))
+
+
+def generate_body(rnd, lines=80, trailers=3):
+    """Generate a message body made of text, a diff and some trailers"""
+
+    tags = sorted(PatchesParser.FLAGS)
+    body = []
+
+    for i in range(lines / 4):
+        body.append('> ' + ' '.join(rnd.choice(['xen', 'domain', 'page', 'irq'])
+                                    for _ in range(8)))
+    for i in range(trailers):
+        tag = rnd.choice(tags)
+        body.append('%s: Jane Doe <jane%d@example.com>' % (tag, rnd.randint(0, 100)))
+
+    body.append('---')
+    body.append('diff --git a/xen/arch/x86/mm.c b/xen/arch/x86/mm.c')
+
+    for i in range(lines - len(body)):
+        body.append(rnd.choice(['+', '-', ' ']) + '    rc = get_page(page, d);')
+
+    return '\n'.join(body)
+
+
+def timed(func, items, repeat):
+    best = None
+
+    for _ in range(repeat):
+        start = time.time()
+        for item in items:
+            func(item)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def bench_trailers(nbodies, repeat, seed=0):
+    rnd = random.Random(seed)
+    bodies = [generate_body(rnd) for _ in range(nbodies)]
+    scanner = TrailerScanner(PatchesParser.FLAGS)
+
+    for body in bodies:
+        assert legacy_scan(body) == scanner.scan(body)
+
+    legacy = timed(legacy_scan, bodies, repeat)
+    current = timed(scanner.scan, bodies, repeat)
+
+    print "Trailers (%d bodies)" % nbodies
+    print "  legacy:  %.3fs" % legacy
+    print "  scanner: %.3fs" % current
+    print "  speedup: %.1fx" % (legacy / current)
+
+
+# Stand-ins for the mlstats and CVSAnalY databases
+
+ARCHIVE_SCHEMA = """
+    CREATE TABLE messages (message_ID VARCHAR(256) PRIMARY KEY,
+                           subject TEXT, message_body TEXT,
+                           first_date TIMESTAMP, first_date_tz INTEGER,
+                           is_response_of VARCHAR(256),
+                           mailing_list_url VARCHAR(256));
+    CREATE INDEX messages_date ON messages (first_date);
+    CREATE TABLE messages_people (message_id VARCHAR(256),
+                                  email_address VARCHAR(256),
+                                  type_of_recipient VARCHAR(16));
+    CREATE INDEX messages_people_id ON messages_people (message_id);
+    CREATE TABLE people (id INTEGER PRIMARY KEY, email VARCHAR(256));
+    CREATE TABLE scmlog (id INTEGER PRIMARY KEY, rev VARCHAR(64),
+                         date TIMESTAMP, author_date TIMESTAMP,
+                         date_tz INTEGER, author_date_tz INTEGER,
+                         message TEXT, author_id INTEGER, committer_id INTEGER);
+    CREATE INDEX scmlog_date ON scmlog (date, id);
+    CREATE TABLE actions (commit_id INTEGER);
+    CREATE INDEX actions_commit ON actions (commit_id);
+    """
+
+
+class SQLiteCursor(object):
+    """Cursor with the interface of MySQLdb dict cursors"""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, query, args=()):
+        query = query.replace('%s', '?').replace('%%', '%')
+        self._cursor.execute(query, args)
+
+    def fetchall(self):
+        return [self.__to_dict(row) for row in self._cursor.fetchall()]
+
+    def fetchmany(self, size):
+        return [self.__to_dict(row) for row in self._cursor.fetchmany(size)]
+
+    def close(self):
+        self._cursor.close()
+
+    def __to_dict(self, row):
+        return dict(zip([d[0] for d in self._cursor.description], row))
+
+
+class SQLiteConnection(object):
+    """Stand-in for MySQLdb connections on top of SQLite"""
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
+
+    def cursor(self, cursorclass=None):
+        return SQLiteCursor(self._conn.cursor())
+
+    def executescript(self, script):
+        self._conn.executescript(script)
+
+    def executemany(self, query, rows):
+        self._conn.executemany(query, rows)
+
+    def commit(self):
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+
+def generate_archive(conn, rnd, nseries, max_versions=3, max_patches=8,
+                     max_replies=4, max_depth=3, trailers=2, merged=0.5):
+    """Generate threads of patch series and the commits that merged them.
+
+    Each series is sent `max_versions` times at most, with up to
+    `max_patches` patches per version; series of more than one patch
+    include a cover letter. Each patch gets up to `max_replies` replies
+    nested up to `max_depth` levels, with up to `trailers` trailers per
+    message. The last version of a share of `merged` series is
+    committed.
+
+    Returns the number of messages and commits generated.
+    """
+    conn.executescript(ARCHIVE_SCHEMA)
+
+    start = datetime.datetime(2012, 1, 1)
+    authors = ['dev%d@example.com' % i for i in range(max(nseries / 10, 10))]
+    messages = []
+    senders = []
+    scmlog = []
+
+    def add_message(subject, date, sender, parent=None):
+        msg_id = '<%d@example.com>' % len(messages)
+        body = generate_body(rnd, lines=40, trailers=rnd.randint(0, trailers))
+        messages.append((msg_id, subject, body, date, 0, parent,
+                         'http://lists.xen.org/xen-devel'))
+        senders.append((msg_id, sender, 'From'))
+        return msg_id
+
+    for s in range(nseries):
+        author = rnd.choice(authors)
+        subject = generate_subject(rnd)
+        date = start + datetime.timedelta(hours=s)
+        npatches = rnd.randint(1, max_patches)
+        nversions = rnd.randint(1, max_versions)
+
+        for v in range(1, nversions + 1):
+            tag = ' v%d' % v if v > 1 else ''
+            prefix = rnd.choice(['', '[Xen-devel] '])
+            patches = []
+
+            if npatches == 1:
+                patches.append((add_message('%s[PATCH%s] %s' % (prefix, tag, subject),
+                                            date, author), subject))
+            else:
+                cover = add_message('%s[PATCH%s 0/%d] %s' % (prefix, tag, npatches, subject),
+                                    date, author)
+
+                for n in range(1, npatches + 1):
+                    patch_subject = '%s (part %d)' % (subject, n)
+                    msg_id = add_message('[PATCH%s %d/%d] %s' % (tag, n, npatches, patch_subject),
+                                         date, author, cover)
+                    patches.append((msg_id, patch_subject))
+
+            for msg_id, patch_subject in patches:
+                thread = [(msg_id, 0)]
+
+                for r in range(rnd.randint(0, max_replies)):
+                    parent, depth = rnd.choice([t for t in thread if t[1] < max_depth])
+                    reply_date = date + datetime.timedelta(minutes=rnd.randint(1, 600))
+                    reply_id = add_message('Re: [PATCH%s] %s' % (tag, patch_subject),
+                                           reply_date, rnd.choice(authors), parent)
+                    thread.append((reply_id, depth + 1))
+
+            date += datetime.timedelta(days=rnd.randint(1, 14))
+
+        if rnd.random() < merged:
+            for msg_id, patch_subject in patches:
+                scmlog.append((len(scmlog), '%040x' % len(scmlog), date, date, 0, 0,
+                               patch_subject + '\n\nSigned-off-by: ' + author,
+                               authors.index(author), 0))
+
+    # Replies are sent after their parents but threads overlap
+    messages.sort(key=lambda m: m[3])
+
+    conn.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?)", messages)
+    conn.executemany("INSERT INTO messages_people VALUES (?, ?, ?)", senders)
+    conn.executemany("INSERT INTO people VALUES (?, ?)", enumerate(authors))
+    conn.executemany("INSERT INTO scmlog VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", scmlog)
+    conn.executemany("INSERT INTO actions VALUES (?)", [(c[0],) for c in scmlog])
+    conn.commit()
+
+    return len(messages), len(scmlog)
+
+
+def run_stage(stats, name, func, *args, **kwargs):
+    """Run a stage of the pipeline, reporting time and peak memory"""
+
+    with stats.stage(name):
+        result = func(*args, **kwargs)
+
+    stage = stats.stages[-1]
+    print "  %-18s %8.3fs  peak RSS %8.1f MB" % (name, stage['seconds'],
+                                                 stage['peak_rss_kb'] / 1024.0)
+
+    return result
+
+
+def bench_pipeline(args, seed=0):
+    rnd = random.Random(seed)
+    stats = Instrumentation()
+    tmpdir = tempfile.mkdtemp()
+
+    try:
+        archive = SQLiteConnection(os.path.join(tmpdir, 'archive.db'))
+
+        print "Pipeline (%d series)" % args.size
+
+        nmessages, ncommits = run_stage(stats, 'generate', generate_archive,
+                                        archive, rnd, args.size,
+                                        max_versions=args.max_versions,
+                                        max_patches=args.max_patches,
+                                        max_replies=args.max_replies,
+                                        max_depth=args.max_depth,
+                                        trailers=args.trailers)
+        print "  %d messages, %d commits" % (nmessages, ncommits)
+
+        threads = run_stage(stats, 'retrieve threads', retrieve_patch_threads,
+                            archive, "2010-01-01", "2100-01-01")
+        commits = run_stage(stats, 'retrieve commits', list,
+                            iter_commits(archive, "2010-01-01", "2100-01-01"))
+
+        parser = PatchesParser(stats=stats)
+        commits, patches_series = run_stage(stats, 'parse', parser.parse,
+                                            threads, commits,
+                                            processes=args.processes)
+
+        db = Database.from_url('sqlite:///' + os.path.join(tmpdir, 'patches.db'))
+        nrows, secs = run_stage(stats, 'store', db.store_many,
+                                patches_series + commits.values())
+        print "  %d rows stored (%.0f rows/sec)" % (nrows, nrows / secs)
+        print "  counters: %s" % ', '.join('%s=%s' % item
+                                           for item in sorted(stats.counters.items()))
+
+        archive.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+BENCHMARKS = ['trailers', 'keys', 'matching', 'pipeline']
+
+
+def parse_args():
+    parser = ArgumentParser(usage="Usage: '%(prog)s [options]")
+
+    parser.add_argument('-b', dest='benchmarks', action='append',
+                        choices=BENCHMARKS,
+                        help='Benchmark to run; by default, all of them')
+    parser.add_argument('-n', dest='size', type=int, default=10000,
+                        help='Number of synthetic items to generate')
+    parser.add_argument('-r', dest='repeat', type=int, default=3,
+                        help='Number of repetitions; the best one is reported')
+
+    # Pipeline options
+    group = parser.add_argument_group('Pipeline options')
+    group.add_argument('--max-versions', dest='max_versions', type=int, default=3,
+                       help='Maximum number of versions of a series')
+    group.add_argument('--max-patches', dest='max_patches', type=int, default=8,
+                       help='Maximum number of patches of a series')
+    group.add_argument('--max-replies', dest='max_replies', type=int, default=4,
+                       help='Maximum number of replies to a patch')
+    group.add_argument('--max-depth', dest='max_depth', type=int, default=3,
+                       help='Maximum depth of the replies')
+    group.add_argument('--trailers', dest='trailers', type=int, default=2,
+                       help='Maximum number of trailers of a message')
+    group.add_argument('--processes', dest='processes', type=int, default=None,
+                       help='Number of processes used to parse the threads')
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    benchmarks = args.benchmarks or BENCHMARKS
+
+    if 'trailers' in benchmarks:
+        bench_trailers(args.size, args.repeat)
+    if 'keys' in benchmarks:
+        bench_keys(args.size * 10, args.repeat)
+    if 'matching' in benchmarks:
+        bench_matching(args.size)
+    if 'pipeline' in benchmarks:
+        bench_pipeline(args)
+
+
+if __name__ == '__main__':
+    main()